@@ -3,6 +3,7 @@ from rdflib.serializer import Serializer
 from rdflib.namespace import RDF, XSD
 from oort.gluon import Profile
 from oort.util.deps import json
+from oort.util.graphs import ListIndex, list_items
 from rdflib.term import URIRef, Literal, BNode
 
 
@@ -25,6 +26,7 @@ class State(object):
         self.lang = lang
         self.base = base
         self.token_for_uri = token_for_uri
+        self.lists = ListIndex(graph)
 
 
 # TODO: reuse rdflib things, e.g. RecursiveSerializer, used-qname-checking..
@@ -181,9 +183,9 @@ def _to_collection(state, subj):
     #    node = dict([_key_and_node(state, RDF.type, rtypes)])
     #    node['$list'] = list(Seq(graph, subj))
     #else:
-    if (subj, RDF.first, None) in graph:
+    if state.lists.is_list(subj):
         node = {'$list': list(_to_raw_value(state, o)
-                                for o in graph.items(subj))}
+                for o in list_items(graph, subj, state.lists))}
     return node
 
 
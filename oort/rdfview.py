@@ -5,14 +5,21 @@ class attributes by using ``Selector``:s. There are several selectors provided
 in this module to cover all regular cases of data acquisition.
 """
 #=======================================================================
-from itertools import chain
+from itertools import chain, count, ifilter, islice
+from copy import copy
 from types import ModuleType
+from time import time
+from contextlib import contextmanager
+import heapq
+import locale
 import warnings
 from rdflib import RDF, RDFS, Namespace, URIRef, BNode, Literal
 from rdflib import ConjunctiveGraph
 try: import simplejson
 except ImportError: simplejson = None
 from oort.util.code import contract
+from oort.util.graphs import (get_generations, GraphRegistry, GraphIndex,
+        ListIndex, list_items)
 #=======================================================================
 
 
@@ -21,6 +28,9 @@ THIS_QUERY = object()
 
 MODULE_SEP = ':'
 
+# Marks a result slot of a query instance as not yet selected.
+_UNSELECTED = object()
+
 
 #-----------------------------------------------------------------------
 
@@ -28,7 +38,10 @@ MODULE_SEP = ':'
 class Selector(object):
     __slots__ = ('predicate', '_namespace', 'filters',
                  '_subQueryMarker', '_finalSubQuery',
-                 '_name', '_queryClass')
+                 '_name', '_queryClass', '_index', 'lazy')
+
+    # Whether this selects a sequence of values (rather than one value).
+    many = False
 
     def __init__(self, predBase=None, subQuery=None):
         self.predicate = None
@@ -40,6 +53,8 @@ class Selector(object):
         self._subQueryMarker = subQuery
         self._finalSubQuery = False
         self.filters = []
+        self._index = None
+        self.lazy = False
 
     @contract.state_change
     def hook_into_rdf_query(self, name, queryClass):
@@ -76,29 +91,68 @@ class Selector(object):
     def __get__(self, rdfQueryInstance, rdfQueryOwnerClass=None):
         if not rdfQueryInstance:
             return self
-        prep = rdfQueryInstance._preparedSelects[self._name]
-        if not prep.hasRun:
-            result = self.retreive_result(rdfQueryInstance, prep.selectArgs)
-            for fltr in self.filters:
-                result = fltr(result)
-            prep.hasRun = True
-            prep.result = result
-        return prep.result
+        if rdfQueryInstance._stamp is not None:
+            rdfQueryInstance._check_generations()
+        result = rdfQueryInstance._results[self._index]
+        if result is _UNSELECTED:
+            result = self._complete(rdfQueryInstance,
+                    self.retreive_result(rdfQueryInstance,
+                        rdfQueryInstance._select_args()))
+        return result
+
+    def _complete(self, rdfQueryInstance, result):
+        if self.filters:
+            result = _timed(self, 'filters', self._filter, result)
+        if rdfQueryInstance._stamp is None:
+            rdfQueryInstance._stamp_selection()
+        rdfQueryInstance._results[self._index] = result
+        return result
+
+    def _filter(self, result):
+        for fltr in self.filters:
+            result = fltr(result)
+        return result
+
+    def is_selected(self, rdfQueryInstance):
+        results = rdfQueryInstance._results
+        return bool(results) and results[self._index] is not _UNSELECTED
+
+    def prefill(self, rdfQueryInstance, rawresult, fill_subqueries=None):
+        """
+        Complete the prepared select of ``rdfQueryInstance`` with a raw result
+        (as acquired by e.g. ``select_many``). If given, ``fill_subqueries`` is
+        called with the result of sub-query processing, before any filters
+        are applied.
+        """
+        if not rdfQueryInstance._results or self.is_selected(rdfQueryInstance):
+            return
+        result = _timed(self, 'subqueries', self._process_for_subqueries,
+                rdfQueryInstance, rawresult,
+                rdfQueryInstance._graph, rdfQueryInstance._lang)
+        if fill_subqueries and result:
+            fill_subqueries(result)
+        self._complete(rdfQueryInstance, result)
 
     @contract.default_method
     def retreive_result(self, rdfQueryInstance, selectArgs):
-        result = self._process_for_subqueries(
+        result = _timed(self, 'subqueries', self._process_for_subqueries,
                 rdfQueryInstance,
-                self.select(*selectArgs),
+                _timed(self, 'select', self._select_for, rdfQueryInstance,
+                    *selectArgs),
                 *selectArgs[:2]
             )
         return result
 
+    def _select_for(self, rdfQueryInstance, graph, lang, subject):
+        return self.select(graph, lang, subject)
+
     def _process_for_subqueries(self, rdfQueryInstance,
             rawresults, graph, lang):
-        returnList = isinstance(rawresults, list)
+        many = self.many
+        if many and self.lazy:
+            rawresults = LazySequence(rawresults)
         if not rawresults:
-            if returnList: return []
+            if many: return rawresults
             else: return None
 
         subQuery = self.get_sub_query()
@@ -108,7 +162,10 @@ class Selector(object):
             # TODO: using THIS_QUERY (and no execCache?) may currently cause
             # infinite loops..? But things are more lazy now; perhaps not..
             run_query = query_or_cached(subQuery, rdfQueryInstance._execCache)
-            if returnList:
+            if self.lazy and many:
+                return LazySequence(run_query(graph, lang, uri)
+                        for uri in rawresults)
+            elif many:
                 return [run_query(graph, lang, uri) for uri in rawresults]
             else:
                 return run_query(graph, lang, rawresults)
@@ -118,6 +175,24 @@ class Selector(object):
         raise NotImplementedError
         return None or []
 
+    @contract.default_method
+    def select_from(self, values, lang):
+        """
+        Select from the given objects (or subjects, for selectors of the
+        "where self is" kind) of the predicate, as already acquired for a
+        subject. Returns None if not supported by this selector.
+        """
+        return None
+
+    @contract.default_method
+    def select_many(self, graph, lang, subjects):
+        """
+        Select for several subjects at once. Returns a dict with the raw
+        result for each subject, or None if this selector cannot be run in
+        bulk (it will then be run lazily per instance).
+        """
+        return None
+
     @contract.default_method
     def back_to_graph(self, graph, subject, value, shallow):
         pass
@@ -129,6 +204,16 @@ class Selector(object):
     def __rshift__(self, subQuery):
         return self.viewed_as(subQuery)
 
+    def lazily(self):
+        """
+        Make the results of this selector (if multiple) a ``LazySequence``,
+        only creating sub-query instances and running filters (that support
+        it, e.g. ``Filter``) for the items actually used. Selectors of ``each``
+        kind then also read their values from the graph as they are used.
+        """
+        self.lazy = True
+        return self
+
     def add_filter(self, fltr):
         self.filters.append(fltr)
 
@@ -137,7 +222,6 @@ class Selector(object):
         return self
 
     def __set__(self, rdfQueryInstance, value):
-        prep = rdfQueryInstance._preparedSelects[self._name]
         lang = rdfQueryInstance._lang
         sub = self.get_sub_query()
         if isinstance(value, list):
@@ -146,13 +230,10 @@ class Selector(object):
             value = self.type_raw_value(value, lang)
         if sub:
             if isinstance(value, list):
-                prep.result = [sub.from_dict(val, lang)
-                                for val in value]
+                value = [sub.from_dict(val, lang) for val in value]
             else:
-                prep.result = sub.from_dict(value, lang)
-        else:
-            prep.result = value
-            prep.hasRun = True
+                value = sub.from_dict(value, lang)
+        rdfQueryInstance._results[self._index] = value
 
     @contract.default_method
     def type_raw_value(self, value, lang):
@@ -162,19 +243,12 @@ class Selector(object):
         return value
 
 
-class PreparedSelect(object):
-    __slots__ = ('selectArgs', 'result', 'hasRun')
-    def __init__(self, graph, lang, subject):
-        self.selectArgs = (graph, lang, subject)
-        self.result = None
-        self.hasRun = False # TODO: make configurable?
-
-
 class _rdf_query_meta(type):
     def __init__(cls, clsName, bases, clsDict):
         super(_rdf_query_meta, cls).__init__(clsName, bases, clsDict)
 
         cls._selectors = selectors = {}
+        cls._fetchPlans = {}
         for base in bases:
             if hasattr(base, '_selectors'):
                 selectors.update(base._selectors)
@@ -192,10 +266,40 @@ class _rdf_query_meta(type):
         else:
             cls._namespace = None # TODO: pick from type?
 
+        own = []
         for key, value in clsDict.items():
             if isinstance(value, Selector):
                 value.hook_into_rdf_query(key, cls)
                 selectors[key] = value
+                own.append(key)
+
+        cls._slotCount = _layout_slots(cls, selectors, own)
+
+
+def _layout_slots(cls, selectors, own):
+    """
+    Give each selector of ``cls`` an index into the result slots of its
+    instances. Inherited selectors keep their index unless it collides with
+    that of another (e.g. from multiple inheritance), in which case a copy
+    with a new index is used by ``cls``.
+    """
+    used, pending = set(), []
+    for name in sorted(selectors):
+        index = selectors[name]._index
+        if name in own or index is None or index in used:
+            pending.append(name)
+        else:
+            used.add(index)
+    free = (i for i in count() if i not in used)
+    for name in pending:
+        selector = selectors[name]
+        if name not in own:
+            selector = copy(selector)
+            setattr(cls, name, selector)
+            selectors[name] = selector
+        selector._index = free.next()
+        used.add(selector._index)
+    return max(used) + 1 if used else 0
 
 
 class RdfQuery(object):
@@ -203,6 +307,9 @@ class RdfQuery(object):
 
     RDF_TYPE = RDFS.Resource
 
+    # Number of sub-query levels to fill in bulk by ``prefetch``.
+    _prefetch_ = 0
+
     # TODO: test use of execCache propertly (it seems to work though)
     # TODO: should graph be wrapped as readonly? Update features won't update
     # it (and its probably a bad idea to allow it, since current idea is that
@@ -213,23 +320,49 @@ class RdfQuery(object):
         self._graph = graph
         self._subject = subject
         self._lang = lang
-        self._preparedSelects = self._make_prepare_selects()
+        self._results = self._new_results()
         self._execCache = execCache
+        self._indexed = getattr(execCache, 'indexed', False)
+        self._stamp = None
 
-    def _make_prepare_selects(self):
-        prepareds = {}
-        graph, lang, subject = self._graph, self._lang, self._subject
-        for name, selector in self._selectors.items():
-            if not subject:
-                # FIXME: happens when subject is a string/Literal - wrong in 
-                # itself! Remove or signal error? As it is, it leads to 
-                # illegible errors further down!
-                # Also, why not: if subject == u'':
-                #setattr(self, name, None) # TODO:removed; see this fixme
-                continue
-            prep = PreparedSelect(graph, lang, subject)
-            prepareds[name] = prep
-        return prepareds
+    def _stamp_selection(self):
+        """
+        Record the generations of the graph contexts describing the subject
+        (if the graph has any), when the first result is selected. (If not,
+        the stamp is False, and the results are reset if the graph has
+        generations by the time they are next read.)
+        """
+        generations = get_generations(self._graph)
+        if generations is not None and self._subject:
+            self._stamp = generations.stamp(self._graph, self._subject)
+        else:
+            self._stamp = False
+
+    def _check_generations(self):
+        """
+        Reset all selected results if any graph context describing the subject
+        has been changed since they were selected.
+        """
+        graph, subject = self._graph, self._subject
+        generations = get_generations(graph)
+        if generations is None:
+            return
+        if (self._stamp is False or
+                not generations.is_current(self._stamp, graph, subject)):
+            self._results = self._new_results()
+            self._stamp = None
+
+    def _new_results(self):
+        if not self._subject:
+            # FIXME: happens when subject is a string/Literal - wrong in 
+            # itself! Remove or signal error? As it is, it leads to 
+            # illegible errors further down!
+            # Also, why not: if subject == u'':
+            return []
+        return [_UNSELECTED] * self._slotCount
+
+    def _select_args(self):
+        return self._graph, self._lang, self._subject
 
     def __str__(self):
         return str(self._subject)
@@ -265,17 +398,82 @@ class RdfQuery(object):
         return instance
 
     @classmethod
-    def find_by(cls, graph, lang, execCache=None, **kwargs):
-        assert len(kwargs) == 1
-        name, value = kwargs.items()[0]
-        predicate = cls._selectors[name].predicate
-        for subject in graph.subjects(predicate, value):
-            yield query_or_cached(cls, execCache)(graph, lang, subject)
+    def find_by(cls, graph, lang, execCache=None, indexed=False,
+            order_by=None, reverse=False, offset=0, limit=None,
+            ignoreCase=False, collate=None, **kwargs):
+        """
+        Find instances for all subjects having all the given selector values,
+        given as keyword arguments (e.g. ``find_by(graph, lang, name=value)``).
+
+        If ``indexed`` is true, the ``FindIndex`` of the graph is used to look
+        up candidate subjects, instead of scanning the graph on each call.
+
+        If ``order_by`` (the name of a selector) is given, the results are
+        sorted by the values of that (see ``SortIndex``, which is used if
+        ``indexed``), with ``ignoreCase`` and ``collate`` as for ``Sorter``.
+        Subjects lacking a value are placed last (also if ``reverse``). Use
+        ``offset`` and ``limit`` to get a page of the results.
+        """
+        assert kwargs
+        constraints = [(cls._selectors[name].predicate, value)
+                for name, value in kwargs.items()]
+        if indexed:
+            subjects = FindIndex.for_graph(graph).find(constraints)
+        else:
+            subjects = _find_subjects(graph, constraints)
+        if order_by:
+            sortArgs = (cls._selectors[order_by].predicate, lang, ignoreCase,
+                    _collation(collate))
+            if indexed:
+                keys = SortIndex.for_graph(graph).keys(*sortArgs)
+            else:
+                keys = _sort_keys(graph, *sortArgs)
+            subjects = _sort_subjects(subjects, keys)
+            subjects = _slice(subjects, offset, limit, reverse,
+                    _count_keyed(subjects, keys))
+        elif offset or limit is not None:
+            subjects = _slice(list(subjects), offset, limit, reverse)
+        run_query = query_or_cached(cls, execCache)
+        for subject in subjects:
+            yield run_query(graph, lang, subject)
+
+    @classmethod
+    def prefetch(cls, graph, lang, subjects, execCache=None, depth=None,
+            pool=None):
+        """
+        Get instances for all given ``subjects``, with the selectors filled in
+        bulk. This scans the graph once per selector for all subjects, instead
+        of once per selector and subject. Selectors not supporting
+        ``select_many`` are left to be run lazily.
+
+        If ``depth`` (defaulting to ``_prefetch_``) is given, selectors of
+        sub-queries are filled in the same manner, level by level, down to
+        that many sub-query levels.
+
+        If a thread ``pool`` is given, all selectors are instead run per
+        instance, concurrently (see ``select_concurrently``).
+        """
+        if depth is None:
+            depth = cls._prefetch_
+        run_query = query_or_cached(cls, execCache)
+        instances = [run_query(graph, lang, subject) for subject in subjects]
+        cls.get_fetch_plan(depth).run(instances, pool)
+        return instances
+
+    @classmethod
+    def get_fetch_plan(cls, depth):
+        plan = cls._fetchPlans.get(depth)
+        if not plan:
+            plan = cls._fetchPlans[depth] = FetchPlan(cls, depth)
+        return plan
 
     uri = property(lambda self: self._subject)
 
     def get_selected_value(self, name):
-        return self._preparedSelects[name].result
+        result = self._results[self._selectors[name]._index]
+        if result is _UNSELECTED:
+            return None
+        return result
 
     def to_graph(self, newgraph=None, autotype=False, shallow=False, deep=()):
         """
@@ -287,34 +485,76 @@ class RdfQuery(object):
         If ``shallow`` is True, do not add subsequent statements about objects
         if they are ``URIRef``:s, unless they are referenced by any eventual
         properties listed in ``deep``.
+
+        If ``newgraph`` is a ``TripleSink``, data is written to that (and it is
+        returned). This is how nested data is written, making sure that each
+        resource is written only once (even if referenced from cycles).
         """
-        subject = self._subject or BNode() # FIXME: is this ok?
-        if not subject: return # FIXME, see fixme in __init__
+        if isinstance(newgraph, TripleSink):
+            self.write_triples(newgraph, autotype, shallow, deep)
+            return newgraph
 
         lgraph = newgraph or ConjunctiveGraph()
         if not newgraph:
             for key, ns in self._graph.namespaces():
                 lgraph.bind(key, ns)
+        self.write_triples(TripleSink(lgraph.add, lgraph),
+                autotype, shallow, deep)
+        return lgraph
+
+    def write_triples(self, sink, autotype=False, shallow=False, deep=()):
+        """
+        Write the statements of contained data to the given ``TripleSink``,
+        unless this has already been done for this query and subject. See
+        ``to_graph`` for the meaning of the other arguments.
+        """
+        for step in self._write_steps(sink, autotype, shallow, deep):
+            pass
+
+    def iter_triples(self, autotype=False, shallow=False, deep=()):
+        """
+        Generate the statements of contained data (those ``to_graph`` would
+        add), as they are acquired from each selector. Shared resources are
+        only described once.
+        """
+        buffered = []
+        sink = TripleSink(buffered.append)
+        for step in self._write_steps(sink, autotype, shallow, deep):
+            for triple in buffered:
+                yield triple
+            del buffered[:]
+
+    def write_ntriples(self, out, autotype=False, shallow=False, deep=()):
+        """
+        Write the statements of contained data as N-Triples to the file-like
+        object ``out``.
+        """
+        for s, p, o in self.iter_triples(autotype, shallow, deep):
+            line = u"%s %s %s .\n" % (_nt_term(s), _nt_term(p), _nt_term(o))
+            out.write(line.encode('ascii'))
+
+    def _write_steps(self, sink, autotype, shallow, deep):
+        subject = self._subject or BNode() # FIXME: is this ok?
+        if not subject: return # FIXME, see fixme in __init__
+        if not sink.visit(self, subject):
+            return
 
         for t in self._graph.objects(subject, RDF.type):
-            lgraph.add((subject, RDF.type, t))
+            sink.add((subject, RDF.type, t))
 
         if autotype and not self._graph.value(self.uri, RDF.type, None):
             if self.RDF_TYPE:
-                lgraph.set((self.uri, RDF.type, self.RDF_TYPE))
+                sink.add((self.uri, RDF.type, self.RDF_TYPE))
+        yield
 
         for selector in self._selectors.values():
             value = selector.__get__(self)
             if not value:
                 continue
             # TODO: never deep for ..where_self_is.. if shallow?
-            selector.back_to_graph(lgraph, subject, value,
+            selector.back_to_graph(sink, subject, value,
                     shallow and selector.predicate not in deep)
-
-        # FIXME: why is this happening; how can we prevent it?
-        for t in lgraph:
-            if None in t: lgraph.remove(t)
-        return lgraph
+            yield
 
     def to_rdf(self, **kwargs):
         return self.to_graph(**kwargs).serialize(format='pretty-xml')
@@ -357,6 +597,109 @@ class RdfQuery(object):
             raise NotImplementedError
 
 
+def _nt_term(term):
+    """
+    Get the N-Triples form of ``term`` (escaped to ASCII). Examples:
+
+        >>> print _nt_term(Literal(u'a "b"\\n\\xe5', lang='en'))
+        "a \\"b\\"\\n\\u00E5"@en
+        >>> print _nt_term(URIRef(u'http://example.org/\\xe5'))
+        <http://example.org/\\u00E5>
+    """
+    if isinstance(term, Literal):
+        text = '"%s"' % _nt_escape(term)
+        if term.language:
+            return text + '@' + term.language
+        if term.datatype:
+            return text + '^^<%s>' % _nt_escape(term.datatype)
+        return text
+    if isinstance(term, BNode):
+        return term.n3()
+    return '<%s>' % _nt_escape(term)
+
+def _nt_escape(text):
+    text = text.replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return ''.join(char if ord(char) < 128 else
+            ('\\u%04X' % ord(char) if ord(char) <= 0xFFFF
+                else '\\U%08X' % ord(char))
+            for char in text)
+
+
+def iter_json(instances, keepSubject=True, dedupe=True):
+    """
+    Stream the given query instances as a JSON array, yielding one chunk per
+    instance (e.g. for use as a WSGI response). The output is that of
+    ``to_json`` for each instance, but is written directly without building
+    intermediate dicts.
+
+    If ``dedupe`` is True, any resource with a URI which has already been
+    written (by the same query) is only given as a reference (a JSON object
+    with just the subject key). Since references need the subject key, resources are always written
+    in full if ``keepSubject`` is False.
+    """
+    if not simplejson:
+        raise NotImplementedError
+    subjectKey = isinstance(keepSubject, str) and keepSubject or 'resource'
+    seen = set() if dedupe and keepSubject else None
+    yield '['
+    sep = ''
+    for instance in instances:
+        parts = [sep]
+        _json_parts(instance, parts, keepSubject and subjectKey, seen)
+        yield ''.join(parts)
+        sep = ','
+    yield ']'
+
+def _json_parts(instance, parts, subjectKey, seen):
+    dumps = simplejson.dumps
+    subject = instance._subject
+    isRef = subject and not isinstance(subject, BNode)
+    if seen is not None and isRef:
+        key = (type(instance), subject)
+        if key in seen:
+            parts.extend(['{', dumps(subjectKey), ':',
+                    dumps(unicode(subject)), '}'])
+            return
+        seen.add(key)
+    parts.append('{')
+    sep = ''
+    if subjectKey and isRef:
+        parts.extend([dumps(subjectKey), ':', dumps(unicode(subject))])
+        sep = ','
+    for selector in instance._selectors.values():
+        value = selector.__get__(instance)
+        if not value:
+            continue
+        parts.extend([sep, dumps(selector._name), ':'])
+        sep = ','
+        if isinstance(value, dict):
+            parts.append('{')
+            itemSep = ''
+            for key, item in value.items():
+                parts.extend([itemSep, dumps(key), ':'])
+                _json_value_parts(item, parts, subjectKey, seen)
+                itemSep = ','
+            parts.append('}')
+        elif hasattr(value, '__iter__'):
+            parts.append('[')
+            itemSep = ''
+            for item in value:
+                parts.append(itemSep)
+                _json_value_parts(item, parts, subjectKey, seen)
+                itemSep = ','
+            parts.append(']')
+        else:
+            _json_value_parts(value, parts, subjectKey, seen)
+    parts.append('}')
+
+def _json_value_parts(value, parts, subjectKey, seen):
+    if isinstance(value, RdfQuery):
+        _json_parts(value, parts, subjectKey, seen)
+    else:
+        parts.append(simplejson.dumps(unicode(value)))
+
+
 #-----------------------------------------------------------------------
 
 
@@ -364,25 +707,332 @@ class RdfQuery(object):
 # references and hence possible memory leaks)?
 # See: <http://docs.python.org/lib/module-weakref.html>
 from weakref import WeakValueDictionary
+from threading import Lock, RLock
+from collections import OrderedDict
 
 class ExecCache(object):
     """
     This is a query execution cache which reuses results for the same query,
     subject and language, avoiding multiple instances of the same query when
-    given the same subject and lang.
+    given the same subject and lang. It is safe to use from several threads.
+
+    If ``indexed``, the instances it makes use the ``LanguageIndex`` and
+    ``ListIndex`` of the graph for localized selectors and collections.
     """
-    def __init__(self):
+    def __init__(self, indexed=False):
+        self.indexed = indexed
         self.cache = WeakValueDictionary()
+        self._lock = RLock()
+        self.hits = self.misses = 0
     def __call__(self, query, graph, lang, subject):
         cache = self.cache
-        key = (id(query), unicode(subject), lang)
+        key = (id(query), unicode(subject), _lang_key(lang))
         #key = (query, subject, lang)
-        result = cache.get(key)
-        if not result:
-            result = query(graph, lang, subject, self)
+        with self._lock:
+            result = cache.get(key)
+            if not result:
+                self.misses += 1
+                result = query(graph, lang, subject, self)
+                cache[key] = result
+            else:
+                self.hits += 1
+        return result
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits) / calls if calls else 0.0
+
+
+class LruExecCache(ExecCache):
+    """
+    A bounded query execution cache, keeping at most ``maxsize`` of the most
+    recently used query instances (evicting the least recently used). Since
+    these are strongly referenced, it can be shared by several query contexts
+    (e.g. over requests) to reuse results in a long-lived process.
+
+    Hits, misses and evictions are counted (see ``stats``). Use ``invalidate``
+    to drop cached instances about subjects in a (changed) graph context. For
+    ``indexed``, see ``ExecCache``.
+    """
+    def __init__(self, maxsize=1024, indexed=False):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got %r." % maxsize)
+        self.indexed = indexed
+        self.cache = OrderedDict()
+        self.maxsize = maxsize
+        self._keysBySubject = {}
+        self._lock = RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, query, graph, lang, subject):
+        cache = self.cache
+        key = (id(query), id(graph), unicode(subject), _lang_key(lang))
+        with self._lock:
+            result = cache.pop(key, None)
+            if result is None:
+                self.misses += 1
+                result = query(graph, lang, subject, self)
+                self._keysBySubject.setdefault(key[2], set()).add(key)
+                while len(cache) >= self.maxsize:
+                    self._discard(cache.popitem(last=False)[0])
+                    self.evictions += 1
+            else:
+                self.hits += 1
             cache[key] = result
         return result
 
+    def _discard(self, key):
+        keys = self._keysBySubject.get(key[2])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._keysBySubject[key[2]]
+
+    def invalidate(self, context=None):
+        """
+        Drop all cached instances whose subject is described in the given
+        ``context`` graph, or all instances if no context is given.
+        """
+        with self._lock:
+            if context is None:
+                self.cache.clear()
+                self._keysBySubject.clear()
+                return
+            for subject in set(context.subjects()):
+                for key in self._keysBySubject.pop(unicode(subject), ()):
+                    self.cache.pop(key, None)
+
+    def stats(self):
+        return dict(size=len(self.cache), maxsize=self.maxsize,
+                hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class FindIndex(GraphIndex):
+    """
+    An index of the subjects of a graph by predicate and object, used by
+    ``RdfQuery.find_by``. The index of a predicate is built on first use.
+    """
+    _indexes = GraphRegistry()
+
+    def invalidate(self):
+        self._byPredicate = {}
+
+    def subjects(self, predicate, value):
+        self._check_generation()
+        def build():
+            byValue = {}
+            for subject, obj in self._graph.subject_objects(predicate):
+                byValue.setdefault(obj, set()).add(subject)
+            return byValue
+        byValue = self._cached(self._byPredicate, predicate, build)
+        return byValue.get(value) or frozenset()
+
+    def find(self, constraints):
+        """
+        Get the set of subjects matching all ``(predicate, value)`` pairs in
+        ``constraints``, intersecting the candidate sets smallest first.
+        """
+        candidates = sorted((self.subjects(predicate, value)
+                for predicate, value in constraints), key=len)
+        result = candidates[0]
+        for subjects in candidates[1:]:
+            if not result:
+                break
+            result = result & subjects
+        return result
+
+
+class TypeIndex(GraphIndex):
+    """
+    An index of the types of subjects and the subjects of types in a graph,
+    as well as of the (transitive) ``rdfs:subClassOf`` superclasses of types.
+    Used by an ``indexed`` ``QueryContext`` for ``find_all`` and ``view_for``.
+    """
+    _indexes = GraphRegistry()
+
+    def invalidate(self):
+        self._cache = {}
+        self._superClasses = {}
+
+    def _get_maps(self):
+        self._check_generation()
+        return self._cached(self._cache, 'maps', self._build_maps)
+
+    def _build_maps(self):
+        typesBySubject, subjectsByType = {}, {}
+        for subject, rdfType in self._graph.subject_objects(RDF.type):
+            typesBySubject.setdefault(subject, []).append(rdfType)
+            subjectsByType.setdefault(rdfType, []).append(subject)
+        return typesBySubject, subjectsByType
+
+    def types(self, subject):
+        return self._get_maps()[0].get(subject, ())
+
+    def subjects(self, rdfType):
+        return self._get_maps()[1].get(rdfType, ())
+
+    def superclasses(self, rdfType):
+        """
+        Get the superclasses of ``rdfType``, nearest first.
+        """
+        self._check_generation()
+        return self._cached(self._superClasses, rdfType,
+                lambda: _superclasses(self._graph, rdfType))
+
+
+def _superclasses(graph, rdfType):
+    superClasses, seen = [], set([rdfType])
+    level = [rdfType]
+    while level:
+        nextLevel = []
+        for cls in level:
+            for sup in graph.objects(cls, RDFS.subClassOf):
+                if sup not in seen:
+                    seen.add(sup)
+                    superClasses.append(sup)
+                    nextLevel.append(sup)
+        level = nextLevel
+    return superClasses
+
+
+class SortIndex(GraphIndex):
+    """
+    An index of sort keys of subjects in a graph, for a given predicate and
+    language (using the value in the first language of its ``language_chain``
+    having one, otherwise the first value), normalized with ``ignoreCase``
+    and ``collate`` (see ``Sorter``). Used to get pages of ``find_all`` and
+    ``find_by`` results in order, without creating instances for subjects
+    outside of the page.
+    """
+    _indexes = GraphRegistry()
+
+    def invalidate(self):
+        self._keys = {}
+        self._ordered = {}
+
+    def keys(self, predicate, lang, ignoreCase=False, collate=None):
+        self._check_generation()
+        args = (predicate, lang, ignoreCase, collate)
+        return self._cached(self._keys, args,
+                lambda: _sort_keys(self._graph, *args))
+
+    def sort(self, subjects, predicate, lang, ignoreCase=False, collate=None):
+        """
+        Sort ``subjects`` by their keys (the subjects lacking a key last).
+        """
+        return _sort_subjects(subjects,
+                self.keys(predicate, lang, ignoreCase, collate))
+
+    def ordered(self, rdfType, predicate, lang, ignoreCase=False,
+            collate=None):
+        """
+        Get all subjects of the given ``rdfType``, sorted.
+        """
+        self._check_generation()
+        args = (predicate, lang, ignoreCase, collate)
+        def build():
+            subjects = TypeIndex.for_graph(self._graph).subjects(rdfType)
+            return self.sort(subjects, *args)
+        return self._cached(self._ordered, (rdfType,) + args, build)
+
+
+def _sort_keys(graph, predicate, lang, ignoreCase=False, collate=None):
+    keys, ranks = {}, {}
+    chain = language_chain(lang)
+    for subject, obj in graph.subject_objects(predicate):
+        language = getattr(obj, 'language', None)
+        rank = chain.index(language) if language in chain else len(chain)
+        if subject not in keys or rank < ranks[subject]:
+            keys[subject] = unicode(obj)
+            ranks[subject] = rank
+    if ignoreCase or collate:
+        for subject, key in keys.iteritems():
+            keys[subject] = _normalized(key, ignoreCase, collate)
+    return keys
+
+def _sort_subjects(subjects, keys):
+    def sortkey(subject):
+        key = keys.get(subject)
+        return (key is None, key, subject)
+    return sorted(subjects, key=sortkey)
+
+def _count_keyed(subjects, keys):
+    """Count the subjects having keys, given them as sorted by these."""
+    low, high = 0, len(subjects)
+    while low < high:
+        middle = (low + high) // 2
+        if subjects[middle] in keys:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _slice(items, offset=0, limit=None, reverse=False, keyed=None):
+    """
+    Get a slice of the ``items`` sequence (from the end if ``reverse``). If
+    ``keyed`` is given, only that many of the first items are reversed, and
+    the rest are kept last. Examples:
+
+        >>> _slice(range(10), 2, 3)
+        [2, 3, 4]
+        >>> _slice(range(10), 2, 3, reverse=True)
+        [7, 6, 5]
+        >>> _slice(range(10), 8, reverse=True)
+        [1, 0]
+        >>> _slice(range(10), 6, reverse=True, keyed=8)
+        [1, 0, 8, 9]
+    """
+    end = offset + limit if limit is not None else None
+    if reverse:
+        size = len(items)
+        keyed = size if keyed is None else keyed
+        end = size if end is None else min(end, size)
+        page = []
+        if offset < keyed:
+            page = items[max(keyed - end, 0):keyed - offset][::-1]
+        if end > keyed:
+            page += items[max(offset, keyed):end]
+        return page
+    return items[offset:end]
+
+
+class LanguageIndex(GraphIndex):
+    """
+    An index of the values of subjects by predicate and language. Used by the
+    selectors of localized values in instances made by an ``indexed``
+    ``ExecCache`` (as used by an ``indexed`` ``QueryContext``).
+    """
+    _indexes = GraphRegistry()
+
+    def invalidate(self):
+        self._byPredicate = {}
+
+    def values(self, subject, predicate):
+        """
+        Get the values of ``predicate`` for ``subject``, and a dict of these
+        by language.
+        """
+        self._check_generation()
+        def build():
+            bySubject = {}
+            for s, obj in self._graph.subject_objects(predicate):
+                entry = bySubject.get(s)
+                if entry is None:
+                    entry = bySubject[s] = ([], {})
+                entry[0].append(obj)
+                entry[1].setdefault(
+                        getattr(obj, 'language', None), []).append(obj)
+            return bySubject
+        bySubject = self._cached(self._byPredicate, predicate, build)
+        return bySubject.get(subject) or ((), {})
+
+
+def _find_subjects(graph, constraints):
+    (predicate, value), rest = constraints[0], constraints[1:]
+    for subject in graph.subjects(predicate, value):
+        if all((subject, p, v) in graph for p, v in rest):
+            yield subject
+
 
 def query_or_cached(rdfQuery, execCache):
     if execCache:
@@ -393,50 +1043,383 @@ def query_or_cached(rdfQuery, execCache):
         return rdfQuery
 
 
-def run_queries(queries, graph, lang, subject):
-    execCache = ExecCache()
+def run_queries(queries, graph, lang, subject, execCache=None):
+    if execCache is None:
+        execCache = ExecCache()
     for query in queries:
         yield execCache(query, graph, lang, subject)
 
 
+def prefill_selects(instances, selectors):
+    """
+    Fill the given ``selectors`` of all ``instances`` (of the same query and
+    with the same graph and language) by using ``Selector.select_many``.
+    """
+    if not instances:
+        return
+    graph, lang = instances[0]._graph, instances[0]._lang
+    for selector in selectors:
+        pending = [inst for inst in instances
+                if inst._results and not selector.is_selected(inst)]
+        if not pending:
+            continue
+        rawresults = _timed(selector, 'select_many', selector.select_many,
+                graph, lang, set(inst._subject for inst in pending))
+        if rawresults is None:
+            continue
+        for inst in pending:
+            selector.prefill(inst, rawresults[inst._subject])
+
+
+def select_concurrently(instances, selectors, pool):
+    """
+    Run the given ``selectors`` of all ``instances``, each in a task of the
+    given thread ``pool`` (e.g. a ``multiprocessing.pool.ThreadPool``). This
+    is useful for graphs where each select blocks on I/O (e.g. those backed by
+    a remote store). Waits until all are done.
+    """
+    tasks = [(inst, selector) for inst in instances if inst._results
+            for selector in selectors if not selector.is_selected(inst)]
+    if tasks:
+        pool.map(_run_select, tasks)
+
+def _run_select(task):
+    rdfQueryInstance, selector = task
+    selector.__get__(rdfQueryInstance)
+
+
+class FetchPlan(object):
+    """
+    A plan for filling the selectors of a query and those of its sub-queries
+    in bulk, breadth-first, down to ``depth`` levels of sub-queries. (The plan
+    is compiled on first use, since sub-queries may be given by name.)
+    """
+
+    def __init__(self, query, depth):
+        self.query = query
+        self.depth = depth
+        self._levels = None
+
+    def get_levels(self):
+        if self._levels is None:
+            self._levels = self._compile()
+        return self._levels
+
+    def _compile(self):
+        levels = []
+        queries = [self.query]
+        for i in range(self.depth + 1):
+            level = [(query, query._selectors.values()) for query in queries]
+            levels.append(level)
+            queries = []
+            for query, selectors in level:
+                for selector in selectors:
+                    sub = selector.get_sub_query()
+                    if sub and sub not in queries:
+                        queries.append(sub)
+        return levels
+
+    def run(self, instances, pool=None):
+        for level in self.get_levels():
+            if not instances:
+                break
+            byQuery = {}
+            for inst in instances:
+                byQuery.setdefault(type(inst), []).append(inst)
+            subInstances, seen = [], set()
+            for query, selectors in level:
+                queryInstances = byQuery.get(query)
+                if not queryInstances:
+                    continue
+                if pool is not None:
+                    select_concurrently(queryInstances, selectors, pool)
+                else:
+                    prefill_selects(queryInstances, selectors)
+                for selector in selectors:
+                    if not selector.get_sub_query():
+                        continue
+                    for inst in queryInstances:
+                        for sub in _sub_instances(inst, selector):
+                            if id(sub) not in seen:
+                                seen.add(id(sub))
+                                subInstances.append(sub)
+            instances = subInstances
+
+def _sub_instances(rdfQueryInstance, selector):
+    if not selector.is_selected(rdfQueryInstance):
+        return ()
+    result = rdfQueryInstance._results[selector._index]
+    if not isinstance(result, (list, LazySequence)):
+        result = [result]
+    return [value for value in result if isinstance(value, RdfQuery)]
+
+
+#-----------------------------------------------------------------------
+
+
+_selectHooks = []
+
+def add_select_hook(hook):
+    """
+    Add a ``hook`` to be called after each phase of running a selector, with
+    the arguments ``(selector, phase, seconds, result)``. The phases are
+    'select', 'select_many' (for several instances at once), 'subqueries'
+    and 'filters'.
+    """
+    global _selectHooks
+    _selectHooks = _selectHooks + [hook]
+
+def remove_select_hook(hook):
+    global _selectHooks
+    _selectHooks = [h for h in _selectHooks if h is not hook]
+
+def _timed(selector, phase, func, *args):
+    hooks = _selectHooks
+    if not hooks:
+        return func(*args)
+    start = time()
+    result = func(*args)
+    seconds = time() - start
+    for hook in hooks:
+        hook(selector, phase, seconds, result)
+    return result
+
+
+class SelectProfiler(object):
+    """
+    A select hook collecting the number of calls, the total time and the
+    total result size of each phase of the selectors, per query class and
+    selector name. See also ``profiling``.
+    """
+    def __init__(self):
+        self.stats = {}
+        self._lock = Lock()
+
+    def __call__(self, selector, phase, seconds, result):
+        key = (selector._queryClass.__name__, selector._name, phase)
+        size = _result_size(result)
+        with self._lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+
+    def report(self, execCache=None):
+        """
+        Get a report of the collected stats, slowest first, including the hit
+        rate of any given ``execCache``.
+        """
+        lines = ["%-40s %-12s %8s %10s %8s" % (
+                "selector", "phase", "count", "time (s)", "size")]
+        for key, (calls, seconds, size) in sorted(self.stats.items(),
+                key=lambda item: -item[1][1]):
+            queryName, name, phase = key
+            lines.append("%-40s %-12s %8d %10.4f %8d" % (
+                    "%s.%s" % (queryName, name), phase, calls, seconds, size))
+        if execCache is not None:
+            lines.append("exec cache hit rate: %.2f" % execCache.hit_rate())
+        return "\n".join(lines)
+
+def _result_size(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple, dict, set)):
+        return len(result)
+    return 1
+
+@contextmanager
+def profiling(profiler=None):
+    """
+    Use as a context manager, collecting stats of all selectors run within it
+    with the given (by default a new) ``SelectProfiler``. Example:
+
+        >>> with profiling() as profiler:
+        ...     pass
+        >>> print profiler.report()
+        selector                                 phase           count   time (s)     size
+    """
+    profiler = profiler or SelectProfiler()
+    add_select_hook(profiler)
+    try:
+        yield profiler
+    finally:
+        remove_select_hook(profiler)
+
+
 #-----------------------------------------------------------------------
 
 
+class LazySequence(object):
+    """
+    A sequence of the items of an iterable, consumed only as far as needed
+    when iterating, indexing, slicing or getting the ``first`` item (and
+    fully when getting the ``len``). Compares equal to lists of the same
+    items. Example:
+
+        >>> seq = LazySequence(iter(range(10)))
+        >>> seq.first(), seq[2], seq[1:3]
+        (0, 2, [1, 2])
+        >>> seq
+        <LazySequence [0, 1, 2, ...]>
+        >>> len(seq), seq == range(10)
+        (10, True)
+
+    """
+    def __init__(self, iterable):
+        self._items = []
+        self._iterator = iter(iterable)
+
+    def _fill(self, size=None):
+        iterator, items = self._iterator, self._items
+        if iterator is None:
+            return
+        if size is None:
+            items.extend(iterator)
+            self._iterator = None
+            return
+        while len(items) < size:
+            try:
+                items.append(iterator.next())
+            except StopIteration:
+                self._iterator = None
+                break
+
+    def __iter__(self):
+        items, i = self._items, 0
+        while True:
+            if i >= len(items):
+                self._fill(i + 1)
+                if i >= len(items):
+                    return
+            yield items[i]
+            i += 1
+
+    def __len__(self):
+        self._fill()
+        return len(self._items)
+
+    def __nonzero__(self):
+        self._fill(1)
+        return bool(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            if start < 0 or stop is None or stop < 0:
+                self._fill()
+            else:
+                self._fill(stop)
+        elif index < 0:
+            self._fill()
+        else:
+            self._fill(index + 1)
+        return self._items[index]
+
+    def first(self):
+        self._fill(1)
+        return self._items[0] if self._items else None
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazySequence)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        more = ", ..." if self._iterator is not None else ""
+        return "<LazySequence [%s%s]>" % (
+                ", ".join(repr(item) for item in self._items), more)
+
+
 class Filter(object):
+    """
+    Filters items by ``func``. A ``LazySequence`` is filtered lazily (giving a
+    new ``LazySequence``), otherwise a list is returned.
+    """
     def __init__(self, func):
         self.func = func
     def __call__(self, items):
+        if isinstance(items, LazySequence):
+            return LazySequence(ifilter(self.func, items))
         return filter(self.func, items)
 
 
 class Sorter(object):
-    def __init__(self, obj=None, reverse=False, ignoreCase=False):
-        if callable(obj):
-            self.attr = None
-            self.func = obj
+    """
+    Sorts items by a key, given as ``obj``: the name of an attribute (items
+    lacking it are used as is), a function, or a tuple or list of those for
+    multi-level keys. The key of each item is computed once.
+
+    String keys are lowercased if ``ignoreCase`` is true, and turned into
+    collation keys with ``collate`` if given (True means
+    ``locale_collation_key``). If ``limit`` is given, only that many of the
+    first items are returned (picked without sorting all items).
+    """
+    def __init__(self, obj=None, reverse=False, ignoreCase=False,
+            collate=None, limit=None):
+        if isinstance(obj, (tuple, list)):
+            self._getters = [_key_getter(o) for o in obj]
         else:
-            self.attr = obj
-            self.func = None
+            self._getters = [_key_getter(obj)]
         self.reverse = reverse
         self.ignoreCase = ignoreCase
+        self.collate = _collation(collate)
+        self.limit = limit
+
     def __call__(self, items):
-        copy = items[:]
-        copy.sort(self.sort)
-        if self.reverse:
-            copy.reverse()
-        return copy
-    def sort(self, r1, r2):
-        attr = self.attr
-        func = self.func
-        if attr:
-            v1, v2 = getattr(r1, attr, r1), getattr(r2, attr, r2)
-        elif func:
-            v1, v2 = func(r1), func(r2)
+        key = self.key
+        decorated = [(key(item), i, item) for i, item in enumerate(items)]
+        if self.limit is not None:
+            pick = heapq.nlargest if self.reverse else heapq.nsmallest
+            decorated = pick(self.limit, decorated)
         else:
-            v1, v2 = r1, r2
-        if self.ignoreCase:
-            v1, v2 = v1.lower(), v2.lower()
-        return cmp(v1, v2)
+            decorated.sort(reverse=self.reverse)
+        return [item for key, i, item in decorated]
+
+    def key(self, item):
+        return tuple(self._normalize(get(item)) for get in self._getters)
+
+    def _normalize(self, value):
+        return _normalized(value, self.ignoreCase, self.collate)
+
+    def sort(self, r1, r2):
+        return cmp(self.key(r1), self.key(r2))
+
+
+def _normalized(value, ignoreCase, collate):
+    if isinstance(value, basestring):
+        if ignoreCase:
+            value = value.lower()
+        if collate:
+            value = collate(value)
+    return value
+
+def _collation(collate):
+    return locale_collation_key if collate is True else collate
+
+def _key_getter(obj):
+    if obj is None:
+        return lambda item: item
+    elif callable(obj):
+        return obj
+    else:
+        return lambda item: getattr(item, obj, item)
+
+
+def locale_collation_key(value):
+    """
+    Get a collation key for the string ``value``, according to the current
+    ``LC_COLLATE`` locale setting.
+    """
+    if isinstance(value, unicode):
+        encoding = locale.getlocale(locale.LC_COLLATE)[1] or 'utf-8'
+        value = value.encode(encoding, 'replace')
+    return locale.strxfrm(value)
 
 
 #-----------------------------------------------------------------------
@@ -458,6 +1441,87 @@ class Sorter(object):
 
 
 
+# Scan all statements of a predicate (instead of looking up each resource)
+# when these are at most this many times the number of resources.
+SCAN_RATIO = 4
+
+def _objects_by_subject(graph, predicate, subjects):
+    index = dict((subject, []) for subject in subjects)
+    pairs = _all_pairs_if_few(graph, predicate, len(index))
+    if pairs is None:
+        for subject, values in index.iteritems():
+            values.extend(graph.objects(subject, predicate))
+        return index
+    for subject, obj in pairs:
+        values = index.get(subject)
+        if values is not None:
+            values.append(obj)
+    return index
+
+def _subjects_by_object(graph, predicate, objects):
+    index = dict((obj, []) for obj in objects)
+    pairs = _all_pairs_if_few(graph, predicate, len(index))
+    if pairs is None:
+        for obj, values in index.iteritems():
+            values.extend(graph.subjects(predicate, obj))
+        return index
+    for subject, obj in pairs:
+        values = index.get(obj)
+        if values is not None:
+            values.append(subject)
+    return index
+
+def _all_pairs_if_few(graph, predicate, count):
+    """
+    Get all (subject, object) pairs of ``predicate`` if there are no more than
+    ``SCAN_RATIO`` times ``count``; otherwise None. Only reads that many.
+    """
+    limit = count * SCAN_RATIO
+    pairs = list(islice(graph.subject_objects(predicate), limit + 1))
+    return pairs if len(pairs) <= limit else None
+
+def _select_from_index(selector, index, lang):
+    return dict((key, selector.select_from(values, lang))
+            for key, values in index.items())
+
+
+class TripleSink(object):
+    """
+    Receives the statements written by ``RdfQuery.write_triples`` (passed on
+    as the graph to ``Selector.back_to_graph``), and passes them on to the
+    given ``add`` function, skipping any statement containing None.
+
+    It also keeps track of which query instances have been written, so that
+    resources shared by several instances are only written once.
+
+    If a target ``graph`` is given, other graph methods are delegated to it.
+    """
+    def __init__(self, add, graph=None):
+        self._add = add
+        self._graph = graph
+        self._visited = set()
+
+    def __getattr__(self, name):
+        if self._graph is None:
+            raise AttributeError(name)
+        return getattr(self._graph, name)
+
+    def add(self, triple):
+        if None not in triple:
+            self._add(triple)
+
+    def visit(self, rdfQueryInstance, subject):
+        """
+        Mark the given subject as written by the query of ``rdfQueryInstance``.
+        Returns False if it already has been.
+        """
+        key = (type(rdfQueryInstance), subject)
+        if key in self._visited:
+            return False
+        self._visited.add(key)
+        return True
+
+
 def back_from_value(graph, subject, predicate, value, shallow=False):
     if isinstance(value, RdfQuery):
         graph.add((subject, predicate, value._subject))
@@ -474,22 +1538,48 @@ class UnarySelector(Selector):
         back_from_value(graph, subject, self.predicate, value, shallow)
 
 class EachSelector(Selector):
+    many = True
+
     def back_to_graph(self, graph, subject, values, shallow):
         for value in values:
             back_from_value(graph, subject, self.predicate, value, shallow)
 
 
-class one(UnarySelector):
+class SelectsFirst(object):
+    def select_from(self, values, lang):
+        for value in values:
+            return value
+        return None
+
+class SelectsAll(object):
+    many = True
+
+    def select_from(self, values, lang):
+        return list(values)
+
+class ObjectsSelector(Selector):
+    def select_many(self, graph, lang, subjects):
+        return _select_from_index(self,
+                _objects_by_subject(graph, self.predicate, subjects), lang)
+
+class SubjectsSelector(Selector):
+    def select_many(self, graph, lang, subjects):
+        return _select_from_index(self,
+                _subjects_by_object(graph, self.predicate, subjects), lang)
+
+
+class one(SelectsFirst, ObjectsSelector, UnarySelector):
     def select(self, graph, lang, subject):
         return graph.value(subject, self.predicate, None, any=True)
 
 
-class each(EachSelector):
+class each(SelectsAll, ObjectsSelector, EachSelector):
     def select(self, graph, lang, subject):
-        return list(graph.objects(subject, self.predicate))
+        objects = graph.objects(subject, self.predicate)
+        return objects if self.lazy else list(objects)
 
 
-class one_where_self_is(Selector):
+class one_where_self_is(SelectsFirst, SubjectsSelector):
     def select(self, graph, lang, subject):
         return graph.value(None, self.predicate, subject, any=True)
 
@@ -499,9 +1589,10 @@ class one_where_self_is(Selector):
         back_from_value(graph, value._subject, self.predicate, subject)
 
 
-class each_where_self_is(Selector):
+class each_where_self_is(SelectsAll, SubjectsSelector):
     def select(self, graph, lang, subject):
-        return list(graph.subjects(self.predicate, subject))
+        subjects = graph.subjects(self.predicate, subject)
+        return subjects if self.lazy else list(subjects)
 
     def back_to_graph(self, graph, subject, values, shallow):
         if shallow:
@@ -511,19 +1602,28 @@ class each_where_self_is(Selector):
 
 
 class collection(Selector):
+    many = True
+
     def __init__(self, predBase=None, subQuery=None, multiple=False):
         Selector.__init__(self, predBase, subQuery)
         self.multiple = multiple
 
     def select(self, graph, lang, subject):
+        return self._select_lists(graph, subject, None)
+
+    def _select_for(self, rdfQueryInstance, graph, lang, subject):
+        index = ListIndex.for_graph(graph) if rdfQueryInstance._indexed else None
+        return self._select_lists(graph, subject, index)
+
+    def _select_lists(self, graph, subject, index):
         if self.multiple:
-            allItems = [graph.items(res)
+            allItems = [list_items(graph, res, index)
                         for res in graph.objects(subject, self.predicate)]
             return list(chain(*allItems))
         else:
-            return list(graph.items(
-                    graph.value(subject, self.predicate, None, any=True)
-                ))
+            return list_items(graph,
+                    graph.value(subject, self.predicate, None, any=True),
+                    index)
 
     def back_to_graph(self, graph, subject, values, shallow):
         if not values:
@@ -542,17 +1642,41 @@ class collection(Selector):
 class TypeLocalized(Selector):
     def type_raw_value(self, value, lang):
         if isinstance(value, basestring):
-            value = Literal(value, lang)
+            value = Literal(value, language_chain(lang)[0])
         return value
 
-class localized(TypeLocalized, UnarySelector):
+class LanguageSelector(ObjectsSelector):
+    """
+    Base for selectors choosing literals by language. The language given may
+    be a fallback chain (see ``language_chain``). For instances made by an
+    ``indexed`` execution cache, values are looked up in the ``LanguageIndex``
+    of the graph.
+    """
     def select(self, graph, lang, subject):
-        first = None
-        for value in graph.objects(subject, self.predicate):
-            if not first: first = value
-            if getattr(value, 'language', None) == lang:
-                return value
-        return first
+        values = list(graph.objects(subject, self.predicate))
+        return self.select_by_language(values, _by_language(values), lang)
+
+    def _select_for(self, rdfQueryInstance, graph, lang, subject):
+        if not rdfQueryInstance._indexed:
+            return self.select(graph, lang, subject)
+        values, byLanguage = LanguageIndex.for_graph(graph).values(subject,
+                self.predicate)
+        return self.select_by_language(values, byLanguage, lang)
+
+    def select_from(self, values, lang):
+        values = list(values)
+        return self.select_by_language(values, _by_language(values), lang)
+
+    @contract.template_method
+    def select_by_language(self, values, byLanguage, lang):
+        raise NotImplementedError
+
+class localized(TypeLocalized, LanguageSelector, UnarySelector):
+    def select_by_language(self, values, byLanguage, lang):
+        for language in language_chain(lang):
+            if language in byLanguage:
+                return byLanguage[language][0]
+        return values[0] if values else None
 
 
 # TODO: This is a hackish solution; see also below (transparently using datatype).
@@ -587,22 +1711,59 @@ else:
                 value = Literal(value, datatype=RDF.XMLLiteral)
             return value
 
-class i18n_dict(Selector):
-    def select(self, graph, lang, subject):
-        valueDict = {}
-        for value in graph.objects(subject, self.predicate):
-            valueDict[value.language] = value
-        return valueDict
+class i18n_dict(LanguageSelector):
+    def select_by_language(self, values, byLanguage, lang):
+        return dict((language, literals[-1])
+                for language, literals in byLanguage.items())
 
     def back_to_graph(self, graph, subject, value, shallow):
         for lang, text in value.items():
             graph.add((subject, self.predicate, Literal(text, lang=lang)))
 
 
-class each_localized(TypeLocalized, EachSelector):
-    def select(self, graph, lang, subject):
-        return [ value for value in graph.objects(subject, self.predicate)
-                 if value.language == lang ]
+class each_localized(TypeLocalized, LanguageSelector, EachSelector):
+    def select_by_language(self, values, byLanguage, lang):
+        for language in language_chain(lang):
+            if language in byLanguage:
+                return list(byLanguage[language])
+        return []
+
+
+_languageChains = {}
+
+def language_chain(lang):
+    """
+    Get the languages to try, in order, for the given language or sequence of
+    languages. Each language tag is followed by its more general prefixes.
+    Examples:
+
+        >>> language_chain('en')
+        ['en']
+        >>> language_chain('sv-FI')
+        ['sv-FI', 'sv']
+        >>> language_chain(('sv-FI', 'sv', 'en'))
+        ['sv-FI', 'sv', 'en']
+    """
+    if isinstance(lang, list):
+        lang = tuple(lang)
+    chain = _languageChains.get(lang)
+    if chain is None:
+        chain = []
+        for tag in lang if isinstance(lang, tuple) else [lang]:
+            parts = tag.split('-') if tag else [tag]
+            for i in range(len(parts), 0, -1):
+                language = '-'.join(parts[:i]) if tag else tag
+                if language not in chain:
+                    chain.append(language)
+        _languageChains[lang] = chain
+    return chain
+
+
+def _by_language(values):
+    byLanguage = {}
+    for value in values:
+        byLanguage.setdefault(getattr(value, 'language', None), []).append(value)
+    return byLanguage
 
 
 #-----------------------------------------------------------------------
@@ -624,7 +1785,7 @@ class selector(Selector):
         super(selector, self).__init__(None)
         self.func = func
     def retreive_result(self, rdfQueryInstance, selectArgs):
-        return self.func(rdfQueryInstance, *selectArgs)
+        return _timed(self, 'select', self.func, rdfQueryInstance, *selectArgs)
     @classmethod
     def filtered_by(cls, *filters):
         def decorator(func):
@@ -649,6 +1810,33 @@ class selector(Selector):
 #-----------------------------------------------------------------------
 
 
+def _lang_getter(langobj):
+    if callable(langobj):
+        return langobj
+    langobj = _lang_key(langobj)
+    def get_lang(): return langobj
+    return get_lang
+
+def _lang_key(lang):
+    """Get ``lang`` as a hashable value (a list of languages as a tuple)."""
+    return tuple(lang) if isinstance(lang, list) else lang
+
+
+class _GenerationCache(object):
+    """
+    Holds a dict of cached values for the current graph generation, replaced
+    by an empty one when the generation changes.
+    """
+    def __init__(self):
+        self._current = (None, {})
+
+    def for_generation(self, generation):
+        current = self._current
+        if current[0] != generation:
+            current = self._current = (generation, {})
+        return current[1]
+
+
 class QueryContext(object):
     """
     A query context, used to provide a managed context for query execution.
@@ -659,30 +1847,73 @@ class QueryContext(object):
     -   language or getter for language
     -   a set of queries or a modules containing queries
         Accessible as attributes on the context or via view_for using RDF_TYPE
+    -   optionally, the number of sub-query levels to ``prefetch`` (overriding
+        that of each query) when getting ``many`` instances
+    -   optionally, an ``execCache`` to use (e.g. a shared ``LruExecCache``);
+        by default a new ``ExecCache`` is used for each context (a given one
+        must be made with the same ``indexed`` value as the context)
+    -   optionally, ``indexed`` to make ``find_by`` use the ``FindIndex`` of
+        the graph, ``view_for`` and ``find_all`` use its ``TypeIndex`` and
+        ``SortIndex``, localized selectors use its ``LanguageIndex`` and
+        collections use its ``ListIndex``
+    -   optionally, a thread ``pool`` (e.g. a
+        ``multiprocessing.pool.ThreadPool``) used to run the selectors of
+        ``many`` instances concurrently (see ``select_concurrently``), and to
+        get instances without blocking with ``many_async``
 
     """
 
     @classmethod
-    def context_factory(cls, graph, langobj, queries=None, query_modules=None):
-        querydict, queryTypeMap = cls._make_query_maps(queries, query_modules)
-        def new_instance():
-            qc = cls(graph, langobj)
-            qc._querydict = querydict
-            qc._queryTypeMap = queryTypeMap
-            return qc
+    def context_factory(cls, graph, langobj, queries=None, query_modules=None,
+            prefetch=None, execCache=None, indexed=False, pool=None):
+        """
+        Get a function returning an ``overlay`` of one shared context, made
+        with the given arguments. It optionally takes a language (or getter)
+        overriding ``langobj``. The shared context can be used from several
+        threads.
+        """
+        shared = cls(graph, langobj, queries, query_modules,
+                prefetch=prefetch, execCache=execCache, indexed=indexed,
+                pool=pool)
+        def new_instance(langobj=None):
+            return shared.overlay(langobj, execCache)
         return new_instance
 
-    def __init__(self, graph, langobj, queries=None, query_modules=None):
+    def __init__(self, graph, langobj, queries=None, query_modules=None,
+            prefetch=None, execCache=None, indexed=False, pool=None):
         self._graph = graph
-        self._execCache = ExecCache()
-        if callable(langobj):
-            get_lang = langobj
-        else:
-            def get_lang(): return langobj
-        self._get_lang = get_lang
+        self._indexed = indexed
+        self._pool = pool
+        self._execCache = self._exec_cache(execCache, indexed)
+        self._prefetch = prefetch
+        self._get_lang = _lang_getter(langobj)
         querydict, queryTypeMap = self._make_query_maps(queries, query_modules)
         self._querydict = querydict
         self._queryTypeMap = queryTypeMap
+        self._queryForTypes = _GenerationCache()
+
+    def overlay(self, langobj=None, execCache=None):
+        """
+        Get a context sharing the graph, queries, settings and caches of this
+        one, but with its own language (if ``langobj`` is given) and
+        ``execCache`` (by default a new ``ExecCache``). This is cheap, and is
+        meant to be done per request.
+        """
+        qc = object.__new__(type(self))
+        qc.__dict__.update(self.__dict__)
+        if langobj is not None:
+            qc._get_lang = _lang_getter(langobj)
+        qc._execCache = self._exec_cache(execCache, self._indexed)
+        return qc
+
+    @staticmethod
+    def _exec_cache(execCache, indexed):
+        if execCache is None:
+            return ExecCache(indexed)
+        if getattr(execCache, 'indexed', False) != indexed:
+            raise ValueError("The execCache of a context must be made with"
+                    " the same indexed value as the context.")
+        return execCache
 
     @staticmethod
     def _make_query_maps(queries, query_modules):
@@ -710,12 +1941,40 @@ class QueryContext(object):
             raise AttributeError("%s has no attribute '%s'" % (self, name))
 
     def view_for(self, uriref):
-        for typeref in self._graph.objects(uriref, RDF.type):
-            query = self._queryTypeMap.get(typeref)
-            if query:
-                return self._prepared_query(query)(uriref)
+        """
+        Get an instance of the query for the type of ``uriref``. If there is
+        no query for any of its types, the query for the nearest superclass
+        (by ``rdfs:subClassOf``) of these is used. If the context is
+        ``indexed``, the types are looked up in the ``TypeIndex`` of the graph.
+        """
+        if self._indexed:
+            typeIndex = TypeIndex.for_graph(self._graph)
+            types = tuple(typeIndex.types(uriref))
+            queryForTypes = self._queryForTypes.for_generation(
+                    typeIndex._generation)
+            query = queryForTypes.get(types)
+            if query is None:
+                query = queryForTypes[types] = self._find_query(types,
+                        typeIndex.superclasses)
+        else:
+            types = list(self._graph.objects(uriref, RDF.type))
+            query = self._find_query(types,
+                    lambda rdfType: _superclasses(self._graph, rdfType))
+        if query:
+            return self._prepared_query(query)(uriref)
         raise KeyError("%s has no query for type '%s'" % (self, uriref))
 
+    def _find_query(self, types, get_superclasses):
+        queryTypeMap = self._queryTypeMap
+        for typeref in types:
+            if typeref in queryTypeMap:
+                return queryTypeMap[typeref]
+        for typeref in types:
+            for superref in get_superclasses(typeref):
+                if superref in queryTypeMap:
+                    return queryTypeMap[superref]
+        return False
+
     def _prepared_query(self, query):
         return self.PreparedQuery(self, query)
 
@@ -730,14 +1989,62 @@ class QueryContext(object):
             cx = self.context
             return cx._execCache(self.query, cx._graph, cx._get_lang(), subject)
 
-        def find_all(self):
+        def many(self, subjects):
+            cx = self.context
+            return self.query.prefetch(cx._graph, cx._get_lang(), subjects,
+                    execCache=cx._execCache, depth=cx._prefetch, pool=cx._pool)
+
+        def many_async(self, subjects, callback=None):
+            """
+            Get ``many`` instances in a task of the thread pool of the
+            context, returning an ``AsyncResult`` (the list of instances is
+            also passed to any given ``callback``). The pool thus limits the
+            number of such tasks running at once.
+            """
             cx = self.context
-            for subject in cx._graph.subjects(RDF.type, self.query.RDF_TYPE):
+            if cx._pool is None:
+                raise ValueError("%s has no thread pool" % cx)
+            return cx._pool.apply_async(self.query.prefetch,
+                    (cx._graph, cx._get_lang(), list(subjects)),
+                    dict(execCache=cx._execCache, depth=cx._prefetch),
+                    callback=callback)
+
+        def find_all(self, order_by=None, reverse=False, offset=0,
+                limit=None, ignoreCase=False, collate=None):
+            """
+            Get instances for all subjects of the query type. Use
+            ``order_by``, ``offset`` and ``limit`` to get a sorted page of
+            these (see ``RdfQuery.find_by``). If the context is ``indexed``,
+            the ``TypeIndex`` and ``SortIndex`` of the graph are used.
+            """
+            cx = self.context
+            graph, rdfType = cx._graph, self.query.RDF_TYPE
+            keyed = None
+            if order_by:
+                sortArgs = (self.query._selectors[order_by].predicate,
+                        cx._get_lang(), ignoreCase, _collation(collate))
+            if cx._indexed and order_by:
+                index = SortIndex.for_graph(graph)
+                subjects = index.ordered(rdfType, *sortArgs)
+                keyed = _count_keyed(subjects, index.keys(*sortArgs))
+            elif cx._indexed:
+                subjects = TypeIndex.for_graph(graph).subjects(rdfType)
+            else:
+                subjects = graph.subjects(RDF.type, rdfType)
+                if order_by:
+                    keys = _sort_keys(graph, *sortArgs)
+                    subjects = _sort_subjects(subjects, keys)
+                    keyed = _count_keyed(subjects, keys)
+                elif offset or limit is not None:
+                    subjects = list(subjects)
+            if order_by or offset or limit is not None:
+                subjects = _slice(subjects, offset, limit, reverse, keyed)
+            for subject in subjects:
                 yield cx.view_for(subject)
 
         def find_by(self, **kwargs):
             cx = self.context
             return self.query.find_by(cx._graph, cx._get_lang(),
-                    execCache=cx._execCache, **kwargs)
+                    execCache=cx._execCache, indexed=cx._indexed, **kwargs)
 
 
@@ -1,13 +1,23 @@
+from threading import local
 from oort.sparqltree.ext import json, autosuper
 from oort.sparqltree.autotree import treeify_results
+from oort.sparqltree.streaming import treeify_stream
 
 
 __metaclass__ = autosuper # TODO: really?
 
 
 class Access:
-    def run_query_to_tree(self, query):
-        return treeify_results(self.run_query(query))
+    def run_query_to_tree(self, query, merge=False, keep_order=True,
+            streaming=False):
+        """
+        Run the query and turn the results into a tree (see
+        ``treeify_results`` for ``merge`` and ``keep_order``). The
+        ``streaming`` option is ignored unless supported by the access (see
+        ``Endpoint``).
+        """
+        return treeify_results(self.run_query(query),
+                merge=merge, keep_order=keep_order)
 
 
 class Endpoint(Access):
@@ -15,7 +25,15 @@ class Endpoint(Access):
         self.__super.__init__()
         self.endpoint_url = endpoint_url
         self.supports_json = supports_json
-        self._wrapper = self._create_wrapper()
+        # wrappers are stateful, so each thread uses its own
+        self._local = local()
+        self._local.wrapper = self._create_wrapper()
+
+    def _get_wrapper(self):
+        wrapper = getattr(self._local, 'wrapper', None)
+        if wrapper is None:
+            wrapper = self._local.wrapper = self._create_wrapper()
+        return wrapper
 
     def _create_wrapper(self):
         try:
@@ -33,11 +51,32 @@ class Endpoint(Access):
         return wrapper
 
     def run_query(self, query):
-        wrapper = self._wrapper
+        wrapper = self._get_wrapper()
         wrapper.setQuery(query)
         results = wrapper.queryAndConvert()
         return results
 
+    def run_query_to_tree(self, query, merge=False, keep_order=True,
+            streaming=False):
+        """
+        As ``Access.run_query_to_tree``. If ``streaming`` is true, the tree is
+        built while reading the response (see ``streaming.treeify_stream``),
+        instead of from the completely parsed results.
+        """
+        if not streaming:
+            return self.__super.run_query_to_tree(query, merge, keep_order)
+        response = self.run_query_stream(query)
+        try:
+            return treeify_stream(response, merge=merge)
+        finally:
+            response.close()
+
+    def run_query_stream(self, query):
+        """Run the query and get the (file-like) response."""
+        wrapper = self._get_wrapper()
+        wrapper.setQuery(query)
+        return wrapper.query().response
+
 
 class GraphAccess(Access):
     def __init__(self, graph):
@@ -0,0 +1,42 @@
+"""
+Access running queries in a bounded pool of worker threads, for callers which
+must not block on each query (e.g. event driven servers). Results are given as
+``multiprocessing.pool.AsyncResult`` objects, and are also passed to any given
+callback when done.
+"""
+from multiprocessing.pool import ThreadPool
+from oort.sparqltree.ext import autosuper
+from oort.sparqltree.access import Endpoint
+
+
+__metaclass__ = autosuper
+
+
+class AsyncAccess:
+    """
+    Wraps a (blocking) ``access``, running at most ``limit`` of its queries at
+    once. A ``pool`` may be given to share worker threads (and the limit) with
+    other uses.
+    """
+    def __init__(self, access, limit=4, pool=None):
+        self.__super.__init__()
+        self.access = access
+        self._pool = pool or ThreadPool(limit)
+
+    def run_query(self, query, callback=None):
+        return self._pool.apply_async(self.access.run_query, (query,),
+                callback=callback)
+
+    def run_query_to_tree(self, query, callback=None, **kwargs):
+        return self._pool.apply_async(self.access.run_query_to_tree, (query,),
+                kwargs, callback=callback)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class AsyncEndpoint(AsyncAccess):
+    def __init__(self, endpoint_url, limit=4, pool=None):
+        self.__super.__init__(Endpoint(endpoint_url), limit, pool)
+
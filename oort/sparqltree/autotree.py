@@ -22,15 +22,28 @@ TYPE_CONVERSION = {
 }
 
 
-def treeify_results(results, root={}):
+def treeify_results(results, root={}, merge=False, keep_order=True):
     """
     Takes an object isomorphic to a parsed SPARQL JSON result and creates a
     tree object (suitable for JSON serialization).
+
+    By default, bindings are only grouped into the same node if adjacent (so
+    the query should be ordered by the resource variables). If ``merge`` is
+    true, all bindings of the same node are grouped, in any order. The nodes
+    are then in first-seen order unless ``keep_order`` is false.
+
+    The results may also be a ``columnar.ResultTable``, whose values are then
+    grouped by their term ids.
     """
-    varmodel = _var_tree_model(results['head']['vars'])
+    if hasattr(results, 'columns'):
+        return _treeify_table(results, root, merge, keep_order)
+    plans = _get_plans(results['head']['vars'])
     bindings = results["results"]["bindings"]
     root = root or {}
-    _fill_nodes(varmodel, root, bindings)
+    if merge:
+        _merge_nodes(plans, root, bindings, keep_order)
+    else:
+        _fill_nodes(plans, root, bindings)
     return root
 
 
@@ -47,57 +60,326 @@ def _var_tree_model(rqvars, sep="__"):
     return vartree
 
 
-def _fill_nodes(varmodel, tree, bindings):
+PLAN_CACHE_SIZE = 256
+
+_plans = {}
+
+def _get_plans(rqvars):
+    """
+    Get the compiled plans (see ``_compile_plans``) for the given variables.
+    These are cached by the variables, so repeated queries skip building the
+    tree model. Example:
+
+        >>> _get_plans([u'a', u'a__1_b']) is _get_plans(['a', 'a__1_b'])
+        True
+    """
+    key = tuple(rqvars)
+    plans = _plans.get(key)
+    if plans is None:
+        plans = _compile_plans(_var_tree_model(rqvars))
+        if len(_plans) >= PLAN_CACHE_SIZE:
+            _plans.clear()
+        _plans[key] = plans
+    return plans
+
+def _compile_plans(varmodel):
+    """
+    Compile a tree model into a tuple of ``(key, use_one, varname, make_node,
+    subplans)``, where ``make_node`` is the node constructor for the role of
+    the variable. Example:
+
+        >>> for key, use_one, varname, make_node, subplans in sorted(
+        ...         _compile_plans(_var_tree_model(['a', 'a__1_b']))):
+        ...     print key, use_one, varname, make_node.__name__, len(subplans)
+        a False a _make_resource_node 1
+    """
+    return tuple(
+            (key, use_one, varname,
+                _make_resource_node if subvarmodel else _make_node,
+                _compile_plans(subvarmodel))
+            for key, (use_one, varname, subvarmodel) in varmodel.items())
+
+
+def _fill_nodes(plans, tree, bindings):
     """Computing a tree model from var names following a given convention."""
-    for key, namedmodel in varmodel.items():
-        use_one, varname, subvarmodel = namedmodel
+    for key, use_one, varname, make_node, subplans in plans:
         nodes = [] #tree.setdefault(key, [])
+        seen = set()
         for keybinding, gbindings in groupby(bindings, lambda b: b.get(varname)):
             if not keybinding:
                 continue
-            node = _make_node(keybinding)
-            # TODO:Ok? Duplicates (due to join combinations) may occur in res,
-            # but should be filtered here by not continuing if keyed value
-            # exists in an already added node..
-            if any(n for n in nodes if n == node or
-                    isinstance(node, dict) and isinstance(n, dict) and
-                    [n.get(k) for k in node] == node.values()):
+            node = make_node(keybinding)
+            # Duplicates (due to join combinations) may occur in res, but are
+            # filtered here by not continuing if an equal node (by the keys
+            # made from the binding) has already been added. (Falsy values,
+            # e.g. 0 or False, have never been filtered.)
+            if node:
+                nodekey = _node_key(node)
+                if nodekey in seen:
+                    continue
+                seen.add(nodekey)
+            nodes.append(node)
+            # NOTE: if node is "literal", subplans should be empty
+            if subplans:
+                _fill_nodes(subplans, node, list(gbindings))
+        tree[key] = _oneify(nodes) if use_one else nodes
+    return tree
+
+
+def _merge_nodes(plans, tree, bindings, keep_order=True):
+    """Like ``_fill_nodes``, but grouping bindings regardless of order."""
+    for key, use_one, varname, make_node, subplans in plans:
+        groups, byRawKey, order = {}, {}, []
+        for binding in bindings:
+            keybinding = binding.get(varname)
+            if not keybinding:
                 continue
+            rawkey = (keybinding['type'], keybinding['value'],
+                    keybinding.get('xml:lang'), keybinding.get('datatype'))
+            group = byRawKey.get(rawkey)
+            if group is None:
+                node = make_node(keybinding)
+                nodekey = _node_key(node)
+                group = groups.get(nodekey)
+                if group is None:
+                    group = groups[nodekey] = (node, [])
+                    if keep_order:
+                        order.append(group)
+                byRawKey[rawkey] = group
+            group[1].append(binding)
+        nodes = []
+        for node, gbindings in order if keep_order else groups.values():
             nodes.append(node)
-            # NOTE: if node is "literal", subvarmodel should be falsy
-            if subvarmodel:
-                _fill_nodes(subvarmodel, node, list(gbindings))
+            # NOTE: if node is "literal", subplans should be empty
+            if subplans:
+                _merge_nodes(subplans, node, gbindings, keep_order)
         tree[key] = _oneify(nodes) if use_one else nodes
     return tree
 
 
-def _make_node(binding):
-    node = {}
-    vtype = binding['type']
-    value = binding['value']
-    if vtype == 'uri':
-        node[URI_KEY] = value
-    elif vtype == 'bnode':
-        node[BNODE_KEY] = value
-    elif vtype == 'literal':
-        lang = binding.get('xml:lang')
-        if lang:
-            node[LANG_TAG+lang] = value
-        else:
-            node = value
-    elif vtype == 'typed-literal':
-        datatype = binding.get('datatype')
-        converter = TYPE_CONVERSION.get(datatype)
-        if converter:
-            node = converter(value)
-        else:
-            node[VALUE_KEY] = value
-            node[DATATYPE_KEY] = datatype
+def _treeify_table(table, root, merge, keep_order):
+    plans = _get_plans(table.vars)
+    rows = xrange(len(table))
+    root = root or {}
+    if merge:
+        _merge_columns(plans, root, table, rows, keep_order)
     else:
-        raise TypeError("Unknown value type: %s" % vtype)
+        _fill_columns(plans, root, table, rows)
+    return root
+
+
+def _fill_columns(plans, tree, table, rows):
+    """As ``_fill_nodes``, for rows of a ``columnar.ResultTable``."""
+    terms = table.terms
+    for key, use_one, varname, make_node, subplans in plans:
+        column = table.columns[varname]
+        nodes = []
+        seen = set()
+        for termid, grows in groupby(rows, column.__getitem__):
+            if not termid:
+                continue
+            node = make_node(terms[termid])
+            if node:
+                nodekey = _node_key(node)
+                if nodekey in seen:
+                    continue
+                seen.add(nodekey)
+            nodes.append(node)
+            if subplans:
+                _fill_columns(subplans, node, table, list(grows))
+        tree[key] = _oneify(nodes) if use_one else nodes
+    return tree
+
+
+def _merge_columns(plans, tree, table, rows, keep_order=True):
+    """As ``_merge_nodes``, for rows of a ``columnar.ResultTable``."""
+    terms = table.terms
+    for key, use_one, varname, make_node, subplans in plans:
+        column = table.columns[varname]
+        groups, byTermId, order = {}, {}, []
+        for row in rows:
+            termid = column[row]
+            if not termid:
+                continue
+            group = byTermId.get(termid)
+            if group is None:
+                node = make_node(terms[termid])
+                nodekey = _node_key(node)
+                group = groups.get(nodekey)
+                if group is None:
+                    group = groups[nodekey] = (node, [])
+                    if keep_order:
+                        order.append(group)
+                byTermId[termid] = group
+            group[1].append(row)
+        nodes = []
+        for node, grows in order if keep_order else groups.values():
+            nodes.append(node)
+            if subplans:
+                _merge_columns(subplans, node, table, grows, keep_order)
+        tree[key] = _oneify(nodes) if use_one else nodes
+    return tree
+
+
+class TreeBuilder(object):
+    """
+    Builds a tree from bindings given one at a time, as ``treeify_results``
+    does from all of them (with the same ``merge`` option; nodes are always in
+    first-seen order). Use ``add`` for each binding, and ``finish`` to get the
+    tree.
+    """
+
+    def __init__(self, rqvars, root=None, merge=False):
+        self.plans = _get_plans(rqvars)
+        self.root = root or {}
+        self.merge = merge
+        self._states = {}
+
+    def add(self, binding):
+        self._add(self.plans, self.root, binding)
+
+    def _add(self, plans, tree, binding):
+        states = self._states.get(id(tree))
+        if states is None:
+            states = self._states[id(tree)] = {}
+        for key, use_one, varname, make_node, subplans in plans:
+            state = states.get(key)
+            if state is None:
+                state = states[key] = _GroupState(make_node)
+                tree[key] = state.nodes
+            keybinding = binding.get(varname)
+            if self.merge:
+                node = state.merged_node(keybinding)
+            else:
+                node = state.adjacent_node(keybinding)
+            # NOTE: if node is "literal", subplans should be empty
+            if node is not None and subplans:
+                self._add(subplans, node, binding)
+
+    def finish(self):
+        self._oneify(self.plans, self.root)
+        self._states.clear()
+        return self.root
+
+    def _oneify(self, plans, tree):
+        for key, use_one, varname, make_node, subplans in plans:
+            nodes = tree.setdefault(key, [])
+            if subplans:
+                for node in nodes:
+                    if isinstance(node, dict):
+                        self._oneify(subplans, node)
+            if use_one:
+                tree[key] = _oneify(nodes)
+
+
+class _GroupState(object):
+    """The nodes for a key of a tree node, and the state of grouping them."""
+    __slots__ = ('make_node', 'nodes', 'seen', 'byRawKey', 'last', 'current')
+
+    def __init__(self, make_node=None):
+        self.make_node = make_node or _make_node
+        self.nodes = []
+        self.seen = {}
+        self.byRawKey = {}
+        self.last = None
+        self.current = None
+
+    def adjacent_node(self, keybinding):
+        # As in _fill_nodes: a binding equal to the previous one continues its
+        # group, and a new group is skipped if its node is a duplicate.
+        if keybinding == self.last:
+            return self.current
+        self.last = keybinding
+        self.current = None
+        if not keybinding:
+            return None
+        node = self.make_node(keybinding)
+        if node:
+            nodekey = _node_key(node)
+            if nodekey in self.seen:
+                return None
+            self.seen[nodekey] = node
+        self.nodes.append(node)
+        self.current = node
+        return node
+
+    def merged_node(self, keybinding):
+        # As in _merge_nodes.
+        if not keybinding:
+            return None
+        rawkey = (keybinding['type'], keybinding['value'],
+                keybinding.get('xml:lang'), keybinding.get('datatype'))
+        node = self.byRawKey.get(rawkey)
+        if node is None:
+            node = self.make_node(keybinding)
+            nodekey = _node_key(node)
+            existing = self.seen.get(nodekey)
+            if existing is None:
+                self.seen[nodekey] = node
+                self.nodes.append(node)
+            else:
+                node = existing
+            self.byRawKey[rawkey] = node
+        return node
+
+
+def _node_key(node):
+    """
+    Get a hashable key identifying a node made by ``_make_node``. Examples:
+
+        >>> _node_key({URI_KEY: 'http://example.org/'}) == _node_key(
+        ...         {URI_KEY: 'http://example.org/'})
+        True
+        >>> _node_key({'@en': 'a'}) == _node_key({'@sv': 'a'})
+        False
+        >>> _node_key(1) == _node_key(True)
+        True
+    """
+    if isinstance(node, dict):
+        return frozenset(node.items())
     return node
 
 
+def _make_node(binding):
+    try:
+        make_node = _NODE_MAKERS[binding['type']]
+    except KeyError:
+        raise TypeError("Unknown value type: %s" % binding['type'])
+    return make_node(binding)
+
+def _make_resource_node(binding):
+    # Variables with sub-variables are almost always bound to resources.
+    if binding['type'] == 'uri':
+        return {URI_KEY: binding['value']}
+    return _make_node(binding)
+
+def _make_uri_node(binding):
+    return {URI_KEY: binding['value']}
+
+def _make_bnode_node(binding):
+    return {BNODE_KEY: binding['value']}
+
+def _make_literal_node(binding):
+    lang = binding.get('xml:lang')
+    if lang:
+        return {LANG_TAG+lang: binding['value']}
+    return binding['value']
+
+def _make_typed_literal_node(binding):
+    datatype = binding.get('datatype')
+    converter = TYPE_CONVERSION.get(datatype)
+    if converter:
+        return converter(binding['value'])
+    return {VALUE_KEY: binding['value'], DATATYPE_KEY: datatype}
+
+_NODE_MAKERS = {
+    'uri': _make_uri_node,
+    'bnode': _make_bnode_node,
+    'literal': _make_literal_node,
+    'typed-literal': _make_typed_literal_node,
+}
+
+
 def _oneify(nodes, lax_one=None):
     if lax_one is None:
         lax_one = LAX_ONE
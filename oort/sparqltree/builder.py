@@ -1,6 +1,6 @@
 from itertools import chain
 
-from oort.sparqltree.autotree import URI_KEY, BNODE_KEY
+from oort.sparqltree.autotree import URI_KEY, BNODE_KEY, treeify_results
 from oort.sparqltree.autotree import is_lang_node, is_datatype_node, is_resource
 
 
@@ -21,6 +21,8 @@ class GraphBuilder(object):
 
     The builder maintains a state of indexed resource nodes, which will be of
     consequence if it is reused.
+
+    A ``columnar.ResultTable`` can also be given, which is first treeified.
     """
 
     def __init__(self, nodelens=None):
@@ -30,6 +32,8 @@ class GraphBuilder(object):
         self._nodelens = nodelens or BasicNodeLens
 
     def to_graph(self, tree):
+        if hasattr(tree, 'columns'):
+            tree = treeify_results(tree)
         graph = self._make_resource(tree, None)
         self._nodelens.complete(
                 chain(self._uri_index.values(), self._blank_index.values()))
@@ -0,0 +1,162 @@
+"""
+A columnar representation of SPARQL results: each distinct term is stored
+once in a term table, and each variable has an array of term ids. This is much
+smaller than the standard list of binding dicts for large results, and lets
+``autotree.treeify_results`` group values by comparing ids.
+"""
+from __future__ import absolute_import
+from array import array
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+from oort.sparqltree.streaming import iter_results, CHUNK_SIZE
+
+
+SPARQL_RESULTS_NS = "http://www.w3.org/2005/sparql-results#"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+UNBOUND = 0
+
+
+class ResultTable(object):
+    """
+    SPARQL results as a table of terms (in the form of SPARQL JSON bindings)
+    and a column of term ids for each variable. Id 0 (``UNBOUND``) is used
+    for unbound values. Example:
+
+        >>> table = ResultTable(['s', 'o'])
+        >>> table.add_binding({'s': {'type': 'uri', 'value': 'urn:x'}})
+        >>> table.add_binding({'s': {'type': 'uri', 'value': 'urn:x'},
+        ...         'o': {'type': 'literal', 'value': 'X'}})
+        >>> len(table), len(table.terms)
+        (2, 3)
+        >>> list(table.columns['s']), list(table.columns['o'])
+        ([1, 1], [0, 2])
+    """
+
+    def __init__(self, rqvars):
+        self.vars = list(rqvars)
+        self.terms = [None]
+        self.columns = dict((var, array('i')) for var in self.vars)
+        self._ids = {}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def intern(self, term):
+        """Get the id of ``term`` (a SPARQL JSON binding value)."""
+        if not term:
+            return UNBOUND
+        key = (term['type'], term['value'],
+                term.get('xml:lang'), term.get('datatype'))
+        termid = self._ids.get(key)
+        if termid is None:
+            termid = self._ids[key] = len(self.terms)
+            self.terms.append(term)
+        return termid
+
+    def add_binding(self, binding):
+        for var, column in self.columns.iteritems():
+            column.append(self.intern(binding.get(var)))
+        self._length += 1
+
+    def iter_bindings(self):
+        terms = self.terms
+        columns = [(var, self.columns[var]) for var in self.vars]
+        for row in xrange(self._length):
+            binding = {}
+            for var, column in columns:
+                termid = column[row]
+                if termid:
+                    binding[var] = terms[termid]
+            yield binding
+
+    def to_json(self):
+        """Get the results in the (parsed) SPARQL JSON results format."""
+        return {'head': {'vars': list(self.vars)},
+                'results': {'bindings': list(self.iter_bindings())}}
+
+
+def from_json(results):
+    """Make a ``ResultTable`` from parsed SPARQL JSON results."""
+    table = ResultTable(results['head']['vars'])
+    for binding in results['results']['bindings']:
+        table.add_binding(binding)
+    return table
+
+
+def load_json(stream, chunksize=CHUNK_SIZE):
+    """
+    Make a ``ResultTable`` from SPARQL JSON results read from a file-like
+    ``stream``, without first parsing all bindings.
+    """
+    table, pending = None, []
+    for kind, value in iter_results(stream, chunksize):
+        if kind == 'head':
+            table = ResultTable(value['vars'])
+            for binding in pending:
+                table.add_binding(binding)
+            pending = None
+        elif table is not None:
+            table.add_binding(value)
+        else:
+            pending.append(value)
+    if table is None:
+        raise ValueError("Found no head in results.")
+    return table
+
+
+def load_xml(source):
+    """
+    Make a ``ResultTable`` from SPARQL XML results read from ``source`` (a
+    file name or file-like object). Literals with a datatype are given the
+    type 'typed-literal', as in the SPARQL JSON results. Example:
+
+        >>> from StringIO import StringIO
+        >>> table = load_xml(StringIO('''
+        ... <sparql xmlns="http://www.w3.org/2005/sparql-results#">
+        ...   <head><variable name="s"/><variable name="label"/></head>
+        ...   <results>
+        ...     <result>
+        ...       <binding name="s"><uri>urn:x</uri></binding>
+        ...       <binding name="label"><literal xml:lang="en">X</literal></binding>
+        ...     </result>
+        ...   </results>
+        ... </sparql>'''))
+        >>> table.to_json()['results']['bindings'] == [{
+        ...     's': {'type': 'uri', 'value': 'urn:x'},
+        ...     'label': {'type': 'literal', 'value': 'X', 'xml:lang': 'en'}}]
+        True
+    """
+    ns = "{%s}" % SPARQL_RESULTS_NS
+    table, rqvars, binding = None, [], {}
+    for event, elem in ElementTree.iterparse(source):
+        tag = elem.tag
+        if tag == ns+'variable':
+            rqvars.append(elem.get('name'))
+        elif tag == ns+'head':
+            table = ResultTable(rqvars)
+        elif tag == ns+'binding':
+            binding[elem.get('name')] = _xml_term(elem[0], ns)
+        elif tag == ns+'result':
+            table.add_binding(binding)
+            binding = {}
+            elem.clear()
+    if table is None:
+        raise ValueError("Found no head in results.")
+    return table
+
+def _xml_term(elem, ns):
+    vtype = elem.tag[len(ns):]
+    term = {'type': vtype, 'value': elem.text or u""}
+    if vtype == 'literal':
+        lang = elem.get(XML_LANG)
+        datatype = elem.get('datatype')
+        if lang:
+            term['xml:lang'] = lang
+        elif datatype:
+            term['type'] = 'typed-literal'
+            term['datatype'] = datatype
+    return term
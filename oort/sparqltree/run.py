@@ -2,12 +2,24 @@
 from __future__ import with_statement
 from oort.sparqltree.ext import json
 from oort.sparqltree.access.util import discover_access
+from oort.sparqltree.streaming import treeify_stream
 
 
 if __name__ == '__main__':
 
     from optparse import OptionParser
-    op = OptionParser("%prog [-h] [...] <endpoint-url> <query-file or '-'>")
+    op = OptionParser("%prog [-h] [...] <endpoint-url> <query-file or '-'>\n"
+            "       %prog --results [...] <results-file or '-'>")
+    op.add_option("--results",
+            action='store_true', default=False,
+            help="Treeify a local SPARQL JSON results file (or stdin),"
+                " parsed incrementally.")
+    op.add_option("--stream",
+            action='store_true', default=False,
+            help="Parse the endpoint response incrementally.")
+    op.add_option("--merge",
+            action='store_true', default=False,
+            help="Group bindings of the same node regardless of order.")
     op.add_option("--raw",
             action='store_true', default=False,
             help="Just dump raw SPARQL, don't do any treeification.")
@@ -19,28 +31,42 @@ if __name__ == '__main__':
             help="Add measured time as comments.")
 
     opts, args = op.parse_args()
-    if len(args) < 2:
+    if len(args) < (1 if opts.results else 2):
         op.print_usage()
         op.exit()
 
-    endpoint_url = args[0]
+    import sys
+    from time import time
+
+    if opts.results:
+        start = time()
+        fpath = args[0]
+        if fpath == "-":
+            tree = treeify_stream(sys.stdin, merge=opts.merge)
+        else:
+            with open(fpath, 'rb') as f:
+                tree = treeify_stream(f, merge=opts.merge)
 
-    fpath = args[1]
-    if fpath == "-":
-        import sys
-        query = sys.stdin.read()
     else:
-        with open(fpath) as f:
-            query = f.read()
+        endpoint_url = args[0]
 
-    from time import time
-    start = time()
+        fpath = args[1]
+        if fpath == "-":
+            query = sys.stdin.read()
+        else:
+            with open(fpath) as f:
+                query = f.read()
 
-    endpoint = discover_access(endpoint_url)
-    if opts.raw:
-        tree = endpoint.run_query(query)
-    else:
-        tree = endpoint.run_query_to_tree(query)
+        start = time()
+
+        endpoint = discover_access(endpoint_url)
+        if opts.raw:
+            tree = endpoint.run_query(query)
+        elif opts.stream:
+            tree = endpoint.run_query_to_tree(query, merge=opts.merge,
+                    streaming=True)
+        else:
+            tree = endpoint.run_query_to_tree(query, merge=opts.merge)
 
     comment_mark = '#' if opts.pprint else '//'
     if opts.time:
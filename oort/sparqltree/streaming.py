@@ -0,0 +1,144 @@
+"""
+Incremental parsing of SPARQL JSON results, for building trees from large
+results without first loading all of them into memory.
+"""
+from oort.sparqltree.ext import json
+from oort.sparqltree.autotree import TreeBuilder
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_results(stream, chunksize=CHUNK_SIZE):
+    """
+    Parse SPARQL JSON results from a file-like ``stream``, yielding
+    ``('head', head)`` and each ``('binding', binding)`` in the order found.
+    Only one binding at a time is held in memory. Example:
+
+        >>> from StringIO import StringIO
+        >>> data = StringIO('{"head": {"vars": ["s"]}, "results": '
+        ...         '{"bindings": [{"s": {"type": "uri", "value": "urn:x"}}]}}')
+        >>> for kind, value in iter_results(data):
+        ...     print kind, value
+        head {u'vars': [u's']}
+        binding {u's': {u'type': u'uri', u'value': u'urn:x'}}
+
+    """
+    reader = _Reader(stream, chunksize)
+    reader.expect('{')
+    for key in reader.iter_keys():
+        if key == 'results':
+            reader.expect('{')
+            for resultsKey in reader.iter_keys():
+                if resultsKey == 'bindings':
+                    reader.expect('[')
+                    for binding in reader.iter_items():
+                        yield 'binding', binding
+                else:
+                    reader.value()
+        elif key == 'head':
+            yield 'head', reader.value()
+        else:
+            reader.value()
+
+
+def treeify_stream(stream, root=None, merge=False, chunksize=CHUNK_SIZE):
+    """
+    Parse SPARQL JSON results from a file-like ``stream`` into a tree (as
+    ``autotree.treeify_results``), one binding at a time. (If the results
+    have bindings before the head, these are kept until the head is found.)
+    """
+    builder, pending = None, []
+    for kind, value in iter_results(stream, chunksize):
+        if kind == 'head':
+            builder = TreeBuilder(value['vars'], root, merge)
+            for binding in pending:
+                builder.add(binding)
+            pending = None
+        elif builder:
+            builder.add(value)
+        else:
+            pending.append(value)
+    if builder is None:
+        raise ValueError("Found no head in results.")
+    return builder.finish()
+
+
+class _Reader(object):
+
+    def __init__(self, stream, chunksize):
+        self._stream = stream
+        self._chunksize = chunksize
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._decode = json.JSONDecoder().raw_decode
+
+    def _read(self):
+        if self._eof:
+            raise ValueError("Unexpected end of JSON data.")
+        chunk = self._stream.read(self._chunksize)
+        if not chunk:
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+    def _next_char(self):
+        while True:
+            buf, pos = self._buffer, self._pos
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            self._read()
+
+    def expect(self, char):
+        if self._next_char() != char:
+            raise ValueError("Expected %r at %r." % (
+                    char, self._buffer[self._pos:self._pos+20]))
+        self._pos += 1
+
+    def value(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self._decode(self._buffer, self._pos)
+            except ValueError:
+                self._read()
+                continue
+            # a number may continue in the next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._read()
+                continue
+            self._pos = end
+            return value
+
+    def iter_keys(self):
+        """Iterate over the keys of an object; the value must be consumed."""
+        if self._next_char() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            char = self._next_char()
+            self._pos += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise ValueError("Expected ',' or '}', got %r." % char)
+
+    def iter_items(self):
+        if self._next_char() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self._next_char()
+            self._pos += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise ValueError("Expected ',' or ']', got %r." % char)
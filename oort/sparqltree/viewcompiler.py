@@ -0,0 +1,281 @@
+"""
+Compiles ``oort.rdfview.RdfQuery`` classes into single SPARQL SELECT queries,
+following the SparqlTree variable naming conventions. The resulting tree is
+used to populate the query instances, so that a whole view can be fetched from
+a remote endpoint in one request.
+"""
+import re
+from rdflib import RDF, URIRef, BNode, Literal, ConjunctiveGraph
+from oort.rdfview import (query_or_cached, one, each, one_where_self_is,
+        each_where_self_is, collection, localized, i18n_dict, each_localized,
+        LazySequence)
+from oort.sparqltree.autotree import (URI_KEY, BNODE_KEY, DATATYPE_KEY,
+        VALUE_KEY, LANG_TAG)
+
+
+SEP = '__'
+ONE = '1_'
+
+
+class SparqlView(object):
+    """
+    A compiled view of an ``RdfQuery`` class. Selectors of the supported kinds
+    (``one``, ``each``, ``localized``, ``i18n_dict``, ``each_localized``,
+    ``one_where_self_is``, ``each_where_self_is`` and ``collection``) are
+    compiled into optional patterns. Sub-queries are compiled into nested
+    patterns, down to ``depth`` levels.
+
+    Populated instances use ``graph`` (by default a new, empty graph) for any
+    selectors which were not compiled (e.g. those made with the ``selector``
+    decorator, or sub-queries below ``depth``).
+
+    Collections are matched with the ``rdf:rest*`` property path, and given
+    subjects are bound with ``VALUES``; both thus require a SPARQL 1.1
+    endpoint. Subjects must be ``URIRef``s.
+    """
+
+    def __init__(self, query, depth=1, rootvar='resource'):
+        self.query = query
+        self.depth = depth
+        self.rootvar = rootvar
+        self._selects = _compile_selects(query, depth)
+
+    def to_sparql(self, subjects=None):
+        root = self.rootvar
+        lines = ["SELECT * WHERE {"]
+        if subjects:
+            lines.append("    VALUES ?%s { %s }" % (root,
+                    " ".join(_uri_n3(subject) for subject in subjects)))
+        else:
+            lines.append("    ?%s a <%s> ." % (root, self.query.RDF_TYPE))
+        orderVars = [root]
+        _add_patterns(lines, orderVars, root, self._selects, 1)
+        lines.append("}")
+        lines.append("ORDER BY " + " ".join("?"+var for var in orderVars))
+        return "\n".join(lines)
+
+    def run(self, access, lang, subjects=None, graph=None, execCache=None):
+        """
+        Run the compiled query using ``access`` (e.g. an
+        ``oort.sparqltree.access.Endpoint``) and return populated instances.
+        """
+        tree = access.run_query_to_tree(self.to_sparql(subjects))
+        return self.populate(tree, lang, graph, execCache)
+
+    def populate(self, tree, lang, graph=None, execCache=None):
+        if graph is None:
+            graph = ConjunctiveGraph()
+        run_query = query_or_cached(self.query, execCache)
+        instances = []
+        for node in tree.get(self.rootvar) or ():
+            instance = run_query(graph, lang, to_term(node))
+            _fill_instance(instance, node, self._selects, lang)
+            instances.append(instance)
+        return instances
+
+
+def _uri_n3(term):
+    """
+    Get a URI for use in a query. Anything but a ``URIRef`` without invalid
+    characters is rejected. Examples:
+
+        >>> _uri_n3(URIRef('http://example.org/'))
+        u'<http://example.org/>'
+        >>> _uri_n3(URIRef('urn:x> } ?s ?p ?o {'))
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid URI: u'urn:x> } ?s ?p ?o {'
+        >>> _uri_n3(BNode('x'))
+        Traceback (most recent call last):
+        ...
+        TypeError: Expected a URIRef, got rdflib.term.BNode('x')
+    """
+    if not isinstance(term, URIRef):
+        raise TypeError("Expected a URIRef, got %r" % term)
+    if _INVALID_URI_CHARS.search(term):
+        raise ValueError("Invalid URI: %r" % unicode(term))
+    return term.n3()
+
+_INVALID_URI_CHARS = re.compile(u'[\x00-\x20<>"{}|^`\\\\]')
+
+
+def to_term(node):
+    """
+    Turn a SparqlTree node into an RDF term. Examples:
+
+        >>> to_term({'$uri': 'http://example.org/'})
+        rdflib.term.URIRef(u'http://example.org/')
+        >>> to_term({'@en': 'Text'}) == Literal(u'Text', lang='en')
+        True
+        >>> to_term({'$value': '1', '$datatype': 'urn:x-type'}).datatype
+        rdflib.term.URIRef(u'urn:x-type')
+    """
+    if isinstance(node, dict):
+        if URI_KEY in node:
+            return URIRef(node[URI_KEY])
+        if BNODE_KEY in node:
+            return BNode(node[BNODE_KEY])
+        if DATATYPE_KEY in node:
+            return Literal(node[VALUE_KEY], datatype=node[DATATYPE_KEY])
+        for key, value in node.items():
+            if key.startswith(LANG_TAG):
+                return Literal(value, lang=key[len(LANG_TAG):])
+    return Literal(node)
+
+
+#-----------------------------------------------------------------------
+
+
+class _Select(object):
+    """A compiled selector, holding eventual compiled sub-query selects."""
+
+    one = False
+    forward = True
+
+    def __init__(self, selector, subSelects):
+        self.selector = selector
+        self.name = selector._name
+        self.subSelects = subSelects
+
+    def var(self, var):
+        return var + SEP + (ONE if self.one else '') + self.name
+
+    def subject_var(self, var):
+        return self.var(var)
+
+    def order_vars(self, var):
+        return [self.var(var)] if self.subSelects else []
+
+    def pattern(self, var):
+        subject, obj = var, self.var(var)
+        if not self.forward:
+            subject, obj = obj, subject
+        return "?%s <%s> ?%s ." % (subject, self.selector.predicate, obj)
+
+    def raw_and_nodes(self, value, lang):
+        if self.one:
+            nodes = [value] if value is not None else []
+        else:
+            nodes = value or []
+        terms = [to_term(node) for node in nodes]
+        return self.selector.select_from(terms, lang), nodes
+
+class _OneSelect(_Select):
+    one = True
+
+class _EachSelect(_Select):
+    pass
+
+class _OneReverseSelect(_OneSelect):
+    forward = False
+
+class _EachReverseSelect(_EachSelect):
+    forward = False
+
+class _CollectionSelect(_Select):
+
+    def cell_var(self, var):
+        return self.var(var) + SEP + 'cell'
+
+    def subject_var(self, var):
+        return self.cell_var(var) + SEP + ONE + 'first'
+
+    def order_vars(self, var):
+        orderVars = [self.var(var), self.cell_var(var)]
+        if self.subSelects:
+            orderVars.append(self.subject_var(var))
+        return orderVars
+
+    def pattern(self, var):
+        listVar, cellVar = self.var(var), self.cell_var(var)
+        return ("?%s <%s> ?%s . "
+                "?%s <%s>* ?%s . ?%s <%s> ?%s ; <%s> ?%s ." % (
+                    var, self.selector.predicate, listVar,
+                    listVar, RDF.rest, cellVar,
+                    cellVar, RDF.first, self.subject_var(var),
+                    RDF.rest, cellVar + SEP + ONE + 'rest'))
+
+    def raw_and_nodes(self, value, lang):
+        heads = value or []
+        if not self.selector.multiple:
+            heads = heads[:1]
+        nodes = []
+        for head in heads:
+            nodes += _list_items(head)
+        return [to_term(node) for node in nodes], nodes
+
+def _list_items(head):
+    cells = dict((cell.get(BNODE_KEY) or cell.get(URI_KEY), cell)
+            for cell in head.get('cell') or ())
+    items, seen = [], set()
+    key = head.get(BNODE_KEY) or head.get(URI_KEY)
+    while key in cells and key not in seen:
+        seen.add(key)
+        cell = cells[key]
+        items.append(cell.get('first'))
+        rest = cell.get('rest') or {}
+        key = rest.get(BNODE_KEY) or rest.get(URI_KEY)
+    return items
+
+
+# Ordered from most to least specific, since selectors may be subclassed.
+_SELECT_KINDS = [
+    (collection, _CollectionSelect),
+    (localized, _EachSelect),
+    (i18n_dict, _EachSelect),
+    (each_localized, _EachSelect),
+    (one_where_self_is, _OneReverseSelect),
+    (each_where_self_is, _EachReverseSelect),
+    (one, _OneSelect),
+    (each, _EachSelect),
+]
+
+_LITERAL_KINDS = (localized, i18n_dict, each_localized)
+
+
+def _compile_selects(query, depth):
+    selects = []
+    for name, selector in sorted(query._selectors.items()):
+        if not selector.predicate:
+            continue
+        for kind, selectType in _SELECT_KINDS:
+            if isinstance(selector, kind):
+                break
+        else:
+            continue
+        subQuery = selector.get_sub_query()
+        subSelects = []
+        if subQuery and depth > 0 and not isinstance(selector, _LITERAL_KINDS):
+            subSelects = _compile_selects(subQuery, depth - 1)
+        selects.append(selectType(selector, subSelects))
+    return selects
+
+
+def _add_patterns(lines, orderVars, var, selects, level):
+    indent = "    " * level
+    for select in selects:
+        orderVars.extend(select.order_vars(var))
+        if not select.subSelects:
+            lines.append("%sOPTIONAL { %s }" % (indent, select.pattern(var)))
+            continue
+        lines.append("%sOPTIONAL { %s" % (indent, select.pattern(var)))
+        _add_patterns(lines, orderVars, select.subject_var(var),
+                select.subSelects, level + 1)
+        lines.append("%s}" % indent)
+
+
+def _fill_instance(instance, node, selects, lang):
+    for select in selects:
+        raw, nodes = select.raw_and_nodes(node.get(select.name), lang)
+        fill_subqueries = None
+        if select.subSelects:
+            def fill_subqueries(result, nodes=nodes, select=select):
+                if isinstance(result, (list, LazySequence)):
+                    subInstances = result
+                else:
+                    subInstances = [result]
+                for subInstance, subNode in zip(subInstances, nodes):
+                    if isinstance(subNode, dict):
+                        _fill_instance(subInstance, subNode,
+                                select.subSelects, lang)
+        select.selector.prefill(instance, raw, fill_subqueries)
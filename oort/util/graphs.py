@@ -3,7 +3,10 @@
 import os
 from os.path import dirname, join, splitext, expanduser
 import logging
-from rdflib import Literal, URIRef, Namespace, ConjunctiveGraph, RDFS
+from weakref import ref
+from threading import Lock, RLock
+from rdflib import (Literal, URIRef, BNode, Namespace, ConjunctiveGraph,
+        RDF, RDFS, XSD)
 #=======================================================================
 
 _logger = logging.getLogger(name=__name__)
@@ -178,7 +181,10 @@ def load_if_modified(graph, fpath, format='xml', contextUri=None):
         graph.remove_context(graph.context_id(contextUri))
         _logger.info('Loading <%s> into <%s>', fpath, contextUri)
         graph.load(fpath, publicID=contextUri, format=format)
-        graph.add((contextUri, LAST_MOD, Literal(modTime)))
+        # Stored with repr to round-trip sub-second precision exactly.
+        graph.add((contextUri, LAST_MOD,
+                Literal(repr(modTime), datatype=XSD.double)))
+        get_generations(graph, create=True).bump(contextUri)
 
 
 def load_dir_if_modified(graph, basedir,
@@ -217,6 +223,258 @@ def load_dir(graph, basedir, formatMap=None, errorHandler=None):
 #-----------------------------------------------------------------------
 
 
+class Generations(object):
+    """
+    Keeps a generation counter for each context of a conjunctive graph. It is
+    bumped whenever a context is (re)loaded or removed by ``load_if_modified``
+    or ``remove_context``. The ``current`` generation is bumped on any change.
+
+    Use ``stamp`` to record the generations of the contexts describing a
+    resource, and ``is_current`` to check if nothing has changed since.
+    Example:
+
+        >>> gens = Generations()
+        >>> graph = ConjunctiveGraph()
+        >>> ctx = URIRef('urn:x-context')
+        >>> s = URIRef('urn:x-s')
+        >>> graph.get_context(ctx).add((s, RDFS.label, Literal('S')))
+        >>> stamp = gens.stamp(graph, s)
+        >>> gens.bump(URIRef('urn:x-other'))
+        >>> gens.is_current(stamp, graph, s)
+        True
+        >>> gens.bump(ctx)
+        >>> gens.is_current(stamp, graph, s)
+        False
+
+    """
+
+    def __init__(self):
+        self.current = 0
+        self._contexts = {}
+
+    def bump(self, contextId):
+        self.current += 1
+        self._contexts[contextId] = self.current
+
+    def get(self, contextId):
+        return self._contexts.get(contextId, 0)
+
+    def stamp(self, graph, resource):
+        return [self.current, self._context_generations(graph, resource)]
+
+    def is_current(self, stamp, graph, resource):
+        if stamp[0] == self.current:
+            return True
+        if self._context_generations(graph, resource) != stamp[1]:
+            return False
+        stamp[0] = self.current
+        return True
+
+    def _context_generations(self, graph, resource):
+        generations = {}
+        for pattern in (resource, None, None), (None, None, resource):
+            for s, p, o, context in graph.quads(pattern):
+                ctxId = context.identifier
+                generations[ctxId] = self.get(ctxId)
+        return generations
+
+
+class GraphRegistry(object):
+    """
+    Maps graphs to values by identity (graphs compare by their identifier, so
+    several graphs may be equal), without keeping the graphs alive. An entry
+    is removed when its graph is freed. Example:
+
+        >>> registry = GraphRegistry()
+        >>> graph, other = ConjunctiveGraph(), ConjunctiveGraph()
+        >>> other.identifier == graph.identifier
+        False
+        >>> registry[graph] = 'value'
+        >>> registry.get(graph), registry.get(ConjunctiveGraph(identifier=
+        ...         graph.identifier))
+        ('value', None)
+        >>> del graph
+        >>> len(registry)
+        0
+    """
+
+    def __init__(self):
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, graph, default=None):
+        item = self._items.get(id(graph))
+        if item is None or item[0]() is not graph:
+            return default
+        return item[1]
+
+    def __setitem__(self, graph, value):
+        graphId, items = id(graph), self._items
+        def remove(graphRef):
+            item = items.get(graphId)
+            if item is not None and item[0] is graphRef:
+                items.pop(graphId, None)
+        items[graphId] = (ref(graph, remove), value)
+
+
+_graphGenerations = GraphRegistry()
+
+def get_generations(graph, create=False):
+    """
+    Get the ``Generations`` of the given graph. Unless ``create`` is True, this
+    is None for graphs not yet changed by the loaders in this module.
+    """
+    generations = _graphGenerations.get(graph)
+    if generations is None and create:
+        generations = _graphGenerations[graph] = Generations()
+    return generations
+
+
+def remove_context(graph, contextUri):
+    """
+    Remove the context with the given ``contextUri`` from ``graph``, bumping
+    its generation.
+    """
+    graph.remove_context(graph.get_context(contextUri))
+    get_generations(graph, create=True).bump(contextUri)
+
+
+#-----------------------------------------------------------------------
+
+
+_indexesLock = Lock()
+
+class GraphIndex(object):
+    """
+    Base for in-memory indexes of a graph. These are built lazily, and are
+    invalidated when the generation of the graph (see ``Generations``) has
+    changed. Use ``for_graph`` to get the shared index of a graph (kept in
+    the ``GraphRegistry`` of the index class, so only while the graph lives).
+
+    Indexes are safe to share between threads. Parts are built (once) under
+    a lock, and only made visible when complete.
+    """
+    _indexes = None
+
+    @classmethod
+    def get(cls, graph):
+        """Get the shared index of ``graph`` if it has been created."""
+        return cls._indexes.get(graph)
+
+    @classmethod
+    def for_graph(cls, graph):
+        index = cls._indexes.get(graph)
+        if index is None:
+            with _indexesLock:
+                index = cls._indexes.get(graph)
+                if index is None:
+                    index = cls._indexes[graph] = cls(graph)
+        return index
+
+    def __init__(self, graph):
+        self._graphRef = ref(graph)
+        self._lock = RLock()
+        self._generation = self._get_generation()
+        self.invalidate()
+
+    _graph = property(lambda self: self._graphRef())
+
+    def _get_generation(self):
+        generations = get_generations(self._graph)
+        return generations and generations.current
+
+    def _check_generation(self):
+        generation = self._get_generation()
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self.invalidate()
+                    self._generation = generation
+
+    def _cached(self, cache, key, build):
+        """
+        Get ``cache[key]``, storing the result of ``build()`` if missing.
+        """
+        value = cache.get(key)
+        if value is None:
+            with self._lock:
+                value = cache.get(key)
+                if value is None:
+                    value = cache[key] = build()
+        return value
+
+    def invalidate(self):
+        raise NotImplementedError
+
+
+class ListIndex(GraphIndex):
+    """
+    An index of the ``rdf:first`` and ``rdf:rest`` values of all RDF list
+    nodes in a graph, built in one pass. Used by ``list_items`` to read many
+    (or long) lists.
+    """
+    _indexes = GraphRegistry()
+
+    def invalidate(self):
+        self._cache = {}
+
+    def _get_maps(self):
+        self._check_generation()
+        return self._cached(self._cache, 'maps', self._build_maps)
+
+    def _build_maps(self):
+        return (dict(self._graph.subject_objects(RDF.first)),
+                dict(self._graph.subject_objects(RDF.rest)))
+
+    def first_and_rest(self, node):
+        firsts, rests = self._get_maps()
+        return firsts.get(node), rests.get(node)
+
+    def is_list(self, node):
+        return node in self._get_maps()[0]
+
+
+def list_items(graph, head, index=None):
+    """
+    Get the items of the RDF list starting at ``head`` (using the given
+    ``ListIndex`` if any). Stops if the list contains a cycle. Example:
+
+        >>> graph = ConjunctiveGraph()
+        >>> a, b = BNode(), BNode()
+        >>> graph.add((a, RDF.first, Literal('x')))
+        >>> graph.add((a, RDF.rest, b))
+        >>> graph.add((b, RDF.first, Literal('y')))
+        >>> graph.add((b, RDF.rest, RDF.nil))
+        >>> list_items(graph, a) == [Literal('x'), Literal('y')]
+        True
+        >>> graph.set((b, RDF.rest, a))
+        >>> items = list_items(graph, a, ListIndex(graph))
+        >>> items == [Literal('x'), Literal('y')]
+        True
+
+    """
+    items, seen = [], set()
+    node = head
+    while node is not None and node != RDF.nil:
+        if node in seen:
+            _logger.warning("Cycle in RDF list <%s> at <%s>", head, node)
+            break
+        seen.add(node)
+        if index is not None:
+            first, node = index.first_and_rest(node)
+        else:
+            first = graph.value(node, RDF.first)
+            node = graph.value(node, RDF.rest)
+        if first is not None:
+            items.append(first)
+    return items
+
+
+#-----------------------------------------------------------------------
+
+
 def replace_uri(graph, old, new, predicates=False):
     newGraph = ConjunctiveGraph()
     for pfx, ns in graph.namespace_manager.namespaces():
@@ -0,0 +1,30 @@
+from oort.sparqltree.autotree import XSD
+
+
+def uri(value):
+    return {'type': 'uri', 'value': value}
+
+def bnode(value):
+    return {'type': 'bnode', 'value': value}
+
+def literal(value, lang=None):
+    term = {'type': 'literal', 'value': value}
+    if lang:
+        term['xml:lang'] = lang
+    return term
+
+def integer(value):
+    return {'type': 'typed-literal', 'value': value, 'datatype': XSD+'integer'}
+
+RESULTS = {
+    "head": {"vars": ["item", "item__1_label", "item__tag", "item__1_size"]},
+    "results": {"bindings": [
+        {"item": uri("urn:a"), "item__1_label": literal("A", 'en'),
+            "item__tag": literal("x"), "item__1_size": integer("1")},
+        {"item": uri("urn:a"), "item__1_label": literal("A", 'en'),
+            "item__tag": literal("y"), "item__1_size": integer("1")},
+        {"item": uri("urn:b"), "item__tag": literal("x")},
+        {"item": uri("urn:a"), "item__1_label": literal("A", 'sv'),
+            "item__tag": literal("z"), "item__1_size": integer("01")},
+    ]}
+}
@@ -0,0 +1,75 @@
+from StringIO import StringIO
+from nose.tools import assert_equals, assert_raises
+from oort.sparqltree.ext import json
+from oort.sparqltree.autotree import treeify_results
+from oort.sparqltree.builder import to_graph, BasicNodeLens
+from oort.sparqltree.columnar import from_json, load_json, load_xml
+from sparqlresults import RESULTS
+
+
+XML_RESULTS = """<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#">
+  <head>
+    <variable name="item"/><variable name="item__1_label"/>
+    <variable name="item__tag"/><variable name="item__1_size"/>
+  </head>
+  <results>
+    <result>
+      <binding name="item"><uri>urn:a</uri></binding>
+      <binding name="item__1_label"><literal xml:lang="en">A</literal></binding>
+      <binding name="item__tag"><literal>x</literal></binding>
+      <binding name="item__1_size"><literal
+          datatype="http://www.w3.org/2001/XMLSchema#integer">1</literal></binding>
+    </result>
+    <result>
+      <binding name="item"><uri>urn:a</uri></binding>
+      <binding name="item__1_label"><literal xml:lang="en">A</literal></binding>
+      <binding name="item__tag"><literal>y</literal></binding>
+      <binding name="item__1_size"><literal
+          datatype="http://www.w3.org/2001/XMLSchema#integer">1</literal></binding>
+    </result>
+    <result>
+      <binding name="item"><uri>urn:b</uri></binding>
+      <binding name="item__tag"><literal>x</literal></binding>
+    </result>
+    <result>
+      <binding name="item"><uri>urn:a</uri></binding>
+      <binding name="item__1_label"><literal xml:lang="sv">A</literal></binding>
+      <binding name="item__tag"><literal>z</literal></binding>
+      <binding name="item__1_size"><literal
+          datatype="http://www.w3.org/2001/XMLSchema#integer">01</literal></binding>
+    </result>
+  </results>
+</sparql>
+"""
+
+
+def test_converters():
+    tables = [from_json(RESULTS),
+            load_json(StringIO(json.dumps(RESULTS)), chunksize=5),
+            load_xml(StringIO(XML_RESULTS))]
+    for table in tables:
+        assert_equals(len(table), 4)
+        # urn:a, A@en, x, 1, y, urn:b, A@sv, z, 01 (and unbound)
+        assert_equals(len(table.terms), 10)
+        assert_equals(table.to_json(), RESULTS)
+
+def test_treeify_table():
+    table = from_json(RESULTS)
+    for merge in (False, True):
+        for keep_order in (True, False):
+            assert_equals(
+                    treeify_results(table, merge=merge, keep_order=keep_order),
+                    treeify_results(RESULTS, merge=merge,
+                        keep_order=keep_order))
+
+def test_graph_from_table():
+    graph = to_graph(BasicNodeLens(), from_json(RESULTS))
+    items = graph['item']
+    assert_equals([item['$uri'] for item in items], ['urn:a', 'urn:b'])
+    assert_equals(items[0]['tag'], ['x', 'y'])
+    assert_equals(items[0]['size'], 1)
+    assert_equals(items[1]['$via'], {'item': [graph]})
+
+def test_load_without_head():
+    assert_raises(ValueError, load_json, StringIO('{"results": {}}'))
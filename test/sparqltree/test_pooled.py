@@ -0,0 +1,35 @@
+from threading import Lock
+from time import sleep
+from nose.tools import assert_equals
+from oort.sparqltree.access import Access
+from oort.sparqltree.access.pooled import AsyncAccess
+
+
+class SlowAccess(Access):
+    def __init__(self):
+        self.running = self.maxRunning = 0
+        self._lock = Lock()
+    def run_query(self, query):
+        with self._lock:
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        sleep(0.02)
+        with self._lock:
+            self.running -= 1
+        return {'head': {'vars': ['value']}, 'results': {'bindings': [
+                {'value': {'type': 'literal', 'value': query}}]}}
+
+
+def test_run_query_to_tree():
+    access = SlowAccess()
+    pooled = AsyncAccess(access, limit=2)
+    done = []
+    try:
+        results = [pooled.run_query_to_tree(str(i), callback=done.append)
+                for i in range(6)]
+        trees = [result.get(5) for result in results]
+    finally:
+        pooled.close()
+    assert_equals([tree['value'] for tree in trees], [[str(i)] for i in range(6)])
+    assert_equals(len(done), 6)
+    assert access.maxRunning <= 2, access.maxRunning
@@ -0,0 +1,47 @@
+from StringIO import StringIO
+from nose.tools import assert_equals, assert_raises
+from oort.sparqltree.ext import json
+from oort.sparqltree.autotree import treeify_results, TreeBuilder
+from oort.sparqltree.streaming import treeify_stream
+from oort.sparqltree.access import Access
+from sparqlresults import RESULTS
+
+
+def test_tree_builder():
+    for merge in (False, True):
+        builder = TreeBuilder(RESULTS['head']['vars'], merge=merge)
+        for binding in RESULTS['results']['bindings']:
+            builder.add(binding)
+        assert_equals(builder.finish(),
+                treeify_results(RESULTS, root={}, merge=merge))
+
+
+def test_treeify_stream():
+    data = json.dumps(RESULTS)
+    for merge in (False, True):
+        expected = treeify_results(RESULTS, root={}, merge=merge)
+        for chunksize in (1, 7, len(data)):
+            assert_equals(
+                    treeify_stream(StringIO(data), merge=merge,
+                        chunksize=chunksize),
+                    expected)
+
+def test_treeify_stream_head_last():
+    data = ('{"results": {"bindings": [{"s": {"type": "uri", "value": "urn:x"}}'
+            ']}, "head": {"vars": ["s"]}}')
+    assert_equals(treeify_stream(StringIO(data)), {'s': [{'$uri': 'urn:x'}]})
+
+def test_treeify_stream_errors():
+    assert_raises(ValueError, treeify_stream,
+            StringIO('{"results": {"bindings": []}}'))
+    assert_raises(ValueError, treeify_stream,
+            StringIO('{"head": {"vars": ["s"]}, "results": {"bindi'))
+
+
+class FixedAccess(Access):
+    def run_query(self, query):
+        return RESULTS
+
+def test_access_ignores_streaming():
+    assert_equals(FixedAccess().run_query_to_tree("", streaming=True),
+            treeify_results(RESULTS, root={}))
@@ -0,0 +1,91 @@
+from nose.tools import assert_equals, assert_raises
+from rdflib import Namespace, URIRef, BNode, Literal
+from oort.rdfview import RdfQuery, one, localized, collection, each_where_self_is
+from oort.sparqltree.autotree import treeify_results
+from oort.sparqltree.viewcompiler import SparqlView
+from sparqlresults import uri, bnode, literal
+
+
+T = Namespace("http://example.org/oort/test#")
+
+class Part(RdfQuery):
+    name = one(T)
+
+class Doc(RdfQuery):
+    name = one(T)
+    title = localized(T)
+    parts = collection(T.partlist) >> Part
+    owner = one(T) >> Part
+    owns = each_where_self_is(T.owner)
+
+
+doc = "http://example.org/doc"
+RDF_NIL = "http://www.w3.org/1999/02/22-rdf-syntax-ns#nil"
+
+def _row(title, cell, first, name, rest):
+    return {
+        'resource': uri(doc),
+        'resource__1_name': literal("Doc"),
+        'resource__title': title,
+        'resource__parts': bnode('l1'),
+        'resource__parts__cell': bnode(cell),
+        'resource__parts__cell__1_first': uri(first),
+        'resource__parts__cell__1_first__1_name': literal(name),
+        'resource__parts__cell__1_rest': rest,
+        'resource__1_owner': uri("http://example.org/owner"),
+        'resource__1_owner__1_name': literal("Owner"),
+    }
+
+RESULTS = {
+    'head': {'vars': sorted(_row(None, None, None, None, None).keys())},
+    'results': {'bindings': [
+        _row(literal("Doc", 'en'), 'l1', "http://example.org/p1", "Part 1",
+            bnode('l2')),
+        _row(literal("Dok", 'sv'), 'l1', "http://example.org/p1", "Part 1",
+            bnode('l2')),
+        _row(literal("Doc", 'en'), 'l2', "http://example.org/p2", "Part 2",
+            uri(RDF_NIL)),
+        _row(literal("Dok", 'sv'), 'l2', "http://example.org/p2", "Part 2",
+            uri(RDF_NIL)),
+    ]}
+}
+
+
+class FakeAccess(object):
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+    def run_query_to_tree(self, query):
+        self.queries.append(query)
+        return treeify_results(self.results)
+
+
+def test_to_sparql():
+    sparql = SparqlView(Doc).to_sparql([URIRef(doc)])
+    assert "VALUES ?resource { <%s> }" % doc in sparql
+    for var in RESULTS['head']['vars']:
+        assert '?'+var in sparql, var
+    assert "?resource__owns <%s> ?resource" % T.owner in sparql
+    assert "ORDER BY ?resource " in sparql
+    sparql = SparqlView(Doc, depth=0).to_sparql()
+    assert "?resource a <%s>" % Doc.RDF_TYPE in sparql
+    assert "resource__1_owner__1_name" not in sparql
+
+def test_to_sparql_checks_subjects():
+    assert_raises(TypeError, SparqlView(Doc).to_sparql, [BNode()])
+    assert_raises(ValueError, SparqlView(Doc).to_sparql,
+            [URIRef("urn:x> . ?s ?p ?o")])
+
+
+def test_run():
+    access = FakeAccess(RESULTS)
+    for lang, title in [('en', "Doc"), ('sv', "Dok")]:
+        item = SparqlView(Doc).run(access, lang, [URIRef(doc)])[0]
+        yield assert_equals, item.uri, URIRef(doc)
+        yield assert_equals, item.name, Literal("Doc")
+        yield assert_equals, item.title, Literal(title, lang)
+        yield assert_equals, [part.name for part in item.parts], \
+                [Literal("Part 1"), Literal("Part 2")]
+        yield assert_equals, item.owner.name, Literal("Owner")
+        yield assert_equals, item.owns, []
+    yield assert_equals, len(access.queries), 2
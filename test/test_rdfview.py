@@ -1,10 +1,14 @@
-from nose.tools import assert_equals
+from multiprocessing.pool import ThreadPool
+from nose.tools import assert_equals, assert_raises
 from rdflib import (ConjunctiveGraph as Graph, URIRef, Literal, BNode,
         Namespace, RDF)
 from oort.rdfview import (RdfQuery, one, each, one_where_self_is,
         each_where_self_is, collection, localized, i18n_dict, each_localized,
-        localized_xml, Sorter, Filter, run_queries, THIS_QUERY, selector)
+        localized_xml, Sorter, Filter, run_queries, THIS_QUERY, selector,
+        LruExecCache, iter_json, LazySequence, LanguageIndex, ExecCache,
+        profiling)
 from oort.util import queries
+from oort.util.graphs import remove_context
 
 
 from helper import siblingpath
@@ -88,6 +92,41 @@ def test_each_localized():
     assert_all_equals(Item(testgraph, en, itemX).labels, [u'En', u'eN'])
     assert_all_equals(Item(testgraph, sv, itemX).labels, [u'Sv', u'sV'])
 
+def test_collection_cycle():
+    graph = Graph()
+    a, b = BNode(), BNode()
+    graph.add((itemX, T.partlist, a))
+    graph.add((a, RDF.first, T.one))
+    graph.add((a, RDF.rest, b))
+    graph.add((b, RDF.first, T.two))
+    graph.add((b, RDF.rest, a))
+    expected = [T.one, T.two]
+    yield assert_equals, Item(graph, en, itemX).partlist, expected
+    indexed = ExecCache(indexed=True)
+    yield assert_equals, Item(graph, en, itemX, indexed).partlist, expected
+
+def test_language_chain():
+    item = Item(testgraph, ('sv-FI', 'en'), itemX)
+    yield assert_equals, item.title, Literal(u'Exempelsak', sv)
+    yield assert_all_equals, item.labels, [u'Sv', u'sV']
+    item = Item(testgraph, ('fi', 'en'), itemX)
+    yield assert_equals, item.title, Literal(u'Example Item', en)
+    yield assert_equals, Item(testgraph, 'fi', itemX).labels, []
+
+def test_language_index():
+    graph = Graph()
+    graph += testgraph
+    item = Item(graph, 'sv-FI', itemX, ExecCache(indexed=True))
+    yield assert_equals, item.title, Literal(u'Exempelsak', sv)
+    yield assert_all_equals, item.labels, [u'Sv', u'sV']
+    yield assert_all_equals, item.titleLang.keys(), ['en', 'sv']
+    yield assert_equals, LanguageIndex.get(graph) is not None, True
+    # instances made without an indexed cache read the graph directly
+    graph.set((itemX, T.name, Literal(u'Changed')))
+    yield assert_equals, Item(graph, 'sv-FI', itemX).name, Literal(u'Changed')
+    graph.remove((itemX, T.title, None))
+    yield assert_equals, Item(graph, 'sv-FI', itemX).title, None
+
 
 class RichItem(Item):
     xmlData = localized_xml(T)
@@ -127,10 +166,84 @@ def test_to_json():
     # TODO: inspect!
 
 
+def test_iter_json():
+    import simplejson
+    item = Item(testgraph, en, itemX)
+    expected = item.to_dict(True)
+    expected['resource'] = unicode(expected['resource'])
+    chunks = list(iter_json([item, item], dedupe=False))
+    yield assert_equals, len(chunks), 4
+    data = simplejson.loads(''.join(chunks))
+    yield assert_equals, data, [expected] * 2
+    data = simplejson.loads(''.join(iter_json([item, item])))
+    yield assert_equals, data[0], expected
+    yield assert_equals, data[1], {'resource': unicode(itemX)}
+    data = simplejson.loads(''.join(iter_json([item, item], keepSubject=False)))
+    yield assert_equals, data, [item.to_dict()] * 2
+    # a resource seen through another query is written in full
+    graph = Graph()
+    doc, part = URIRef('urn:x-test:doc'), URIRef('urn:x-test:part')
+    graph.add((doc, T.unaryRelation, part))
+    graph.add((part, T.name, Literal(u'Part')))
+    graph.add((part, T.title, Literal(u'Title', lang=en)))
+    data = simplejson.loads(''.join(iter_json(
+            [Item(graph, en, doc), Item(graph, en, part)])))
+    yield assert_equals, data[0]['unaryRelation'], {
+            'resource': unicode(part), 'name': u'Part'}
+    yield assert_equals, (data[1]['resource'], data[1]['title']), \
+            (unicode(part), u'Title')
+
+
 def test_to_graph():
     graph = Item(testgraph, en, itemX).to_graph()
     # TODO: inspect!
 
+def test_iter_triples():
+    for query in Owner, Creation, Part, ImplicitItem:
+        yield assert_equals, set(query(testgraph, en, itemX).iter_triples()), \
+                set(query(testgraph, en, itemX).to_graph())
+    triples = list(Item(testgraph, en, itemX).iter_triples())
+    yield assert_equals, len(set(triples)), len(Item(testgraph, en, itemX).to_graph())
+
+
+class Cyclic(RdfQuery):
+    related = each(T.relation) >> 'Cyclic'
+
+def test_iter_triples_visits_once():
+    a, b = URIRef('urn:x-test:a'), URIRef('urn:x-test:b')
+    graph = Graph()
+    graph.add((a, T.relation, b))
+    graph.add((b, T.relation, a))
+    triples = list(Cyclic(graph, en, a).iter_triples())
+    yield assert_equals, sorted(triples), \
+            [(a, T.relation, b), (b, T.relation, a)]
+
+def test_to_graph_cyclic():
+    a, b = URIRef('urn:x-test:a'), URIRef('urn:x-test:b')
+    graph = Graph()
+    graph.add((a, T.relation, b))
+    graph.add((b, T.relation, a))
+    lgraph = Cyclic(graph, en, a).to_graph()
+    assert_equals(set(lgraph), set(graph))
+
+
+def test_write_ntriples():
+    from StringIO import StringIO
+    out = StringIO()
+    Owner(testgraph, en, itemX).write_ntriples(out)
+    graph = Graph()
+    graph.parse(data=out.getvalue(), format='nt')
+    yield assert_equals, set(graph), set(Owner(testgraph, en, itemX).to_graph())
+    # literals must be escaped as N-Triples, not written as Turtle
+    source = Graph()
+    source.add((itemX, T.name, Literal(u"line 1\nline \"2\"\t\\ \u00e5")))
+    out = StringIO()
+    Part(source, en, itemX).write_ntriples(out)
+    graph = Graph()
+    graph.parse(data=out.getvalue(), format='nt')
+    yield assert_equals, set(graph), set(source)
+
+
 def test_to_graph_shallow():
     pass # FIXME! Also with opt. deep..
 
@@ -182,6 +295,48 @@ def test_filter():
     yield assert_some, item
 
 
+def test_sorter():
+    items = [(2, u'b'), (1, u'B'), (2, u'A'), (1, u'a')]
+    second = lambda v: v[1]
+    yield assert_equals, Sorter(second)(items), [
+            (2, u'A'), (1, u'B'), (1, u'a'), (2, u'b')]
+    yield assert_equals, Sorter(second, ignoreCase=True)(items), [
+            (2, u'A'), (1, u'a'), (2, u'b'), (1, u'B')]
+    yield assert_equals, Sorter((lambda v: v[0], second))(items), [
+            (1, u'B'), (1, u'a'), (2, u'A'), (2, u'b')]
+    yield assert_equals, Sorter(second, limit=2, reverse=True)(items), [
+            (2, u'b'), (1, u'a')]
+    yield assert_equals, Sorter(second, collate=lambda v: v[::-1])(
+            [u'ab', u'ba']), [u'ba', u'ab']
+    yield assert_equals, Sorter(collate=True)([u'b', u'a']), [u'a', u'b']
+
+
+class LazyItem(RdfQuery):
+    keywords = each(T.keyword).lazily() | Filter(lambda v: v != 'e')
+    relations = each(T.relation).lazily() >> Item
+
+def test_lazily():
+    item = LazyItem(testgraph, en, itemX)
+    keywords = item.keywords
+    assert isinstance(keywords, LazySequence)
+    assert keywords.first() in "q r t w y".split()
+    assert sorted(keywords) == "q r t w y".split()
+    assert len(keywords) == 5
+    relations = item.relations
+    assert isinstance(relations[0], Item)
+    assert len(relations[:1]) == 1
+    assert sorted(rel.name for rel in relations) == ['Related 1', 'Related 2']
+
+def test_lazily_reads_from_graph():
+    selector = LazyItem.__dict__['keywords']
+    assert not isinstance(selector.select(testgraph, en, itemX), list)
+    keywords = LazyItem(testgraph, en, itemX).keywords
+    assert keywords._iterator is not None
+    keywords.first()
+    assert len(keywords._items) == 1
+    assert LazyItem(testgraph, en, URIRef("urn:x-test:none")).keywords == []
+
+
 def test_selector_filtered_by():
 
     class ItemWithSelectorAndFilter(Item):
@@ -270,6 +425,130 @@ def test_find_by():
         yield assert_equals, list(found)[0].uri, itemX
 
 
+def test_find_by_several():
+    found = Item.find_by(testgraph, en, name=Literal(u'Item X'),
+            title=Literal(u'Example Item', en))
+    yield assert_equals, [item.uri for item in found], [itemX]
+    found = Item.find_by(testgraph, en, name=Literal(u'Item X'),
+            title=Literal(u'Other Item', en))
+    yield assert_equals, list(found), []
+
+def test_find_by_indexed():
+    graph = Graph()
+    ctx = URIRef('urn:x-test:context')
+    graph.get_context(ctx).add((itemX, T.name, Literal(u'Item X')))
+    found = Item.find_by(graph, en, indexed=True, name=Literal(u'Item X'))
+    yield assert_equals, [item.uri for item in found], [itemX]
+    other = URIRef('urn:x-test:other')
+    # not a tracked change, so the index is kept
+    graph.add((other, T.name, Literal(u'Item X')))
+    found = Item.find_by(graph, en, indexed=True, name=Literal(u'Item X'))
+    yield assert_equals, len(list(found)), 1
+    remove_context(graph, ctx)
+    found = Item.find_by(graph, en, indexed=True, name=Literal(u'Item X'))
+    yield assert_equals, [item.uri for item in found], [other]
+
+
+def test_prefetch():
+    partA = URIRef('tag:oort.to,2006:test:part:a')
+    items = Item.prefetch(testgraph, en, [itemX, partA])
+    yield assert_equals, [item.uri for item in items], [itemX, partA]
+    item, part = items
+    for name in ('name', 'title', 'relations', 'titleLang', 'labels'):
+        yield assert_equals, getattr(Item, name).is_selected(item), True
+    yield assert_equals, Part.name.is_selected(item.partlist[0]), False
+    lazy = Item(testgraph, en, itemX)
+    yield assert_equals, item.name, lazy.name
+    yield assert_equals, item.title, lazy.title
+    yield assert_equals, item.titleLang, lazy.titleLang
+    yield assert_all_equals, item.labels, [u'En', u'eN']
+    yield assert_equals, set(rel.name for rel in item.relations), \
+            set(rel.name for rel in lazy.relations)
+    yield assert_equals, part.name, Literal(u'Part A')
+    yield assert_equals, part.relations, []
+    yield assert_equals, part.title, None
+
+def test_prefetch_by_lookups():
+    from oort import rdfview
+    partA = URIRef('tag:oort.to,2006:test:part:a')
+    scanned = Item.prefetch(testgraph, en, [itemX, partA])
+    ratio, rdfview.SCAN_RATIO = rdfview.SCAN_RATIO, 0
+    try:
+        looked_up = Item.prefetch(testgraph, en, [itemX, partA])
+    finally:
+        rdfview.SCAN_RATIO = ratio
+    for name in ('name', 'title', 'titleLang', 'labels'):
+        yield assert_equals, [getattr(item, name) for item in looked_up], \
+                [getattr(item, name) for item in scanned]
+    yield assert_equals, set(rel.uri for rel in looked_up[0].relations), \
+            set(rel.uri for rel in scanned[0].relations)
+
+def test_prefetch_sub_queries():
+    item = Item.prefetch(testgraph, en, [itemX], depth=1)[0]
+    for sub in item.relations + [item.unaryRelation]:
+        yield assert_equals, type(sub).name.is_selected(sub), True
+    shallow = Item.prefetch(testgraph, en, [itemX], depth=0)[0]
+    yield assert_equals, \
+            Part.name.is_selected(shallow.unaryRelation), False
+    yield assert_equals, item.unaryRelation.name, u'One Relation'
+
+def test_prefetch_concurrently():
+    pool = ThreadPool(4)
+    try:
+        item = Item.prefetch(testgraph, en, [itemX], depth=1, pool=pool)[0]
+    finally:
+        pool.close()
+    for selector in Item._selectors.values():
+        yield assert_equals, selector.is_selected(item), True
+    for sub in item.relations + [item.unaryRelation]:
+        yield assert_equals, type(sub).name.is_selected(sub), True
+    yield assert_equals, item.unaryRelation.name, u'One Relation'
+
+def test_profiling():
+    with profiling() as profiler:
+        item = Item(testgraph, en, itemX)
+        item.relations, item.name
+        Item.prefetch(testgraph, en, [itemX])
+    stats = profiler.stats
+    yield assert_equals, stats[('Part', 'name', 'select')][:1], [1]
+    # once lazily, once prefetched
+    calls, seconds, size = stats[('Item', 'relations', 'subqueries')]
+    yield assert_equals, (calls, size), (2, 4)
+    yield assert_equals, ('Item', 'title', 'select_many') in stats, True
+    yield assert_equals, ('Item', 'title', 'select') in stats, False
+    cache = ExecCache()
+    items = [cache(Item, testgraph, en, itemX) for i in range(2)]
+    yield assert_equals, cache.hit_rate(), 0.5
+    yield assert_equals, profiler.report(cache).splitlines()[-1], \
+            "exec cache hit rate: 0.50"
+
+
+def test_prefetch_where_self_is():
+    owner, creation = Owner.prefetch(testgraph, en, [itemX])[0], \
+            Creation.prefetch(testgraph, en, [itemX])[0]
+    yield assert_equals, set(part.name for part in owner.owns), \
+            set(["Part A", "Part B"])
+    yield assert_equals, creation.createdBy.name, "Creator"
+
+
+class Named(RdfQuery):
+    name = one(T)
+
+class Titled(RdfQuery):
+    title = localized(T)
+
+class NamedAndTitled(Named, Titled):
+    pass
+
+def test_slot_layout_with_multiple_bases():
+    item = NamedAndTitled(testgraph, en, itemX)
+    yield assert_equals, item.name, Literal(u'Item X')
+    yield assert_equals, item.title, Literal(u'Example Item', en)
+    yield assert_equals, NamedAndTitled._slotCount, 2
+    yield assert_equals, Titled(testgraph, sv, itemX).title, \
+            Literal(u'Exempelsak', sv)
+
+
 #---------------------------------------
 
 class MarkedItem(RdfQuery):
@@ -319,3 +598,25 @@ def test_exec_cache():
         yield test.test_i18n_dict ,
 
 
+
+
+def test_lru_exec_cache():
+    cache = LruExecCache(maxsize=2)
+    item = cache(Item, testgraph, en, itemX)
+    yield assert_equals, cache(Item, testgraph, en, itemX) is item, True
+    yield assert_equals, cache(Item, testgraph, sv, itemX) is item, False
+    cache(Part, testgraph, en, itemX)
+    yield assert_equals, cache.stats(), dict(size=2, maxsize=2,
+            hits=1, misses=3, evictions=1)
+    yield assert_equals, cache(Item, testgraph, en, itemX) is item, False
+    cache.invalidate(testgraph)
+    yield assert_equals, cache.stats()['size'], 0
+
+    yield assert_raises, ValueError, LruExecCache, 0
+
+
+def test_shared_exec_cache():
+    cache = LruExecCache()
+    first, second = [list(run_queries([Item], testgraph, en, itemX, cache))[0]
+            for i in range(2)]
+    assert first is second
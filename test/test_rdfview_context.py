@@ -1,5 +1,9 @@
-from rdflib import Literal
-from oort.rdfview import QueryContext
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+from nose.tools import assert_raises
+from rdflib import ConjunctiveGraph as Graph, URIRef, Literal, RDF, RDFS
+from oort.rdfview import QueryContext, LruExecCache
+from oort.util.graphs import remove_context
 
 
 from test_rdfview import T, testgraph, itemX, Item
@@ -34,11 +38,118 @@ class TestQueryContext(object):
         assert isinstance(item, TypedItem)
         assert_item_facts(item)
 
+    def test_by_find_superclass(self):
+        graph = Graph()
+        graph.add((itemX, RDF.type, T.SpecialItem))
+        graph.add((T.SpecialItem, RDFS.subClassOf, T.Item))
+        for indexed in (False, True):
+            context = QueryContext(graph, 'en', queries=[TypedItem],
+                    indexed=indexed)
+            assert isinstance(context.view_for(itemX), TypedItem)
+            assert list(context.TypedItem.find_all()) == []
+
+    def test_query_for_types_per_generation(self):
+        graph = Graph()
+        graph.add((itemX, RDF.type, T.Item))
+        context = QueryContext(graph, 'en', queries=[TypedItem], indexed=True)
+        for i in range(3):
+            assert isinstance(context.view_for(itemX), TypedItem)
+            remove_context(graph, URIRef('urn:x-test:other'))
+        # only the queries found in the latest generation are kept
+        assert len(context._queryForTypes._current[1]) == 1
+
+    def test_find_all_paged(self):
+        graph = Graph()
+        for i, name in enumerate([u'c', u'a', u'd', u'b']):
+            subject = URIRef('urn:x-test:%s' % i)
+            graph.add((subject, RDF.type, T.Item))
+            graph.add((subject, T.name, Literal(name)))
+            if i:
+                graph.add((subject, T.unaryRelation, T.shared))
+        def names(items):
+            return [item.name for item in items]
+        for indexed in (False, True):
+            context = QueryContext(graph, 'en', queries=[TypedItem],
+                    indexed=indexed)
+            assert names(context.TypedItem.find_all(order_by='name')) == [
+                    u'a', u'b', u'c', u'd']
+            assert names(context.TypedItem.find_all(order_by='name',
+                    offset=1, limit=2)) == [u'b', u'c']
+            assert names(context.TypedItem.find_all(order_by='name',
+                    reverse=True, limit=3)) == [u'd', u'c', u'b']
+            assert len(list(context.TypedItem.find_all(offset=3))) == 1
+            found = context.TypedItem.find_by(unaryRelation=T.shared,
+                    order_by='name', offset=1)
+            assert names(found) == [u'b', u'd']
+
+    def test_find_all_sorted_keyless_last(self):
+        graph = Graph()
+        for i, name in enumerate([u'b', u'C', None, u'a']):
+            subject = URIRef('urn:x-test:%s' % i)
+            graph.add((subject, RDF.type, T.Item))
+            graph.add((subject, T.unaryRelation, T.shared))
+            if name:
+                graph.add((subject, T.name, Literal(name)))
+        def names(items):
+            return [item.name for item in items]
+        for indexed in (False, True):
+            context = QueryContext(graph, 'en', queries=[TypedItem],
+                    indexed=indexed)
+            find_all = context.TypedItem.find_all
+            assert names(find_all(order_by='name')) == [
+                    u'C', u'a', u'b', None]
+            assert names(find_all(order_by='name', ignoreCase=True)) == [
+                    u'a', u'b', u'C', None]
+            assert names(find_all(order_by='name', ignoreCase=True,
+                    reverse=True)) == [u'C', u'b', u'a', None]
+            assert names(find_all(order_by='name', reverse=True,
+                    offset=2, limit=2)) == [u'C', None]
+            found = context.TypedItem.find_by(unaryRelation=T.shared,
+                    order_by='name', reverse=True, collate=unicode.lower)
+            assert names(found) == [u'C', u'b', u'a', None]
+
+    def test_unindexed_sees_changes(self):
+        graph = Graph()
+        a, b = URIRef('urn:x-test:a'), URIRef('urn:x-test:b')
+        graph.add((a, RDF.type, T.Item))
+        context = QueryContext(graph, 'en', queries=[TypedItem])
+        assert [item.uri for item in context.TypedItem.find_all()] == [a]
+        graph.add((b, RDF.type, T.Item))
+        context = QueryContext(graph, 'en', queries=[TypedItem])
+        assert set(item.uri for item in context.TypedItem.find_all()) == \
+                set([a, b])
+        assert context.view_for(b).uri == b
+
     def test_by_attr_and_find_by(self):
         context = QueryContext(testgraph, 'en', queries=[Item])
         found = context.Item.find_by(name=Literal(u'Item X'))
         assert list(found)[0].uri == itemX
 
+    def test_many(self):
+        context = QueryContext(testgraph, 'en', queries=[Item])
+        items = context.Item.many([itemX])
+        assert_item_facts(items[0])
+        assert items[0] is context.Item(itemX)
+
+    def test_many_with_pool(self):
+        pool = ThreadPool(2)
+        context = QueryContext(testgraph, 'en', queries=[Item], pool=pool)
+        try:
+            items = context.Item.many([itemX])
+        finally:
+            pool.close()
+        assert Item.title.is_selected(items[0])
+        assert_item_facts(items[0])
+
+    def test_many_async(self):
+        pool = ThreadPool(2)
+        context = QueryContext(testgraph, 'en', queries=[Item], pool=pool)
+        try:
+            items = context.Item.many_async([itemX]).get(5)
+        finally:
+            pool.close()
+        assert_item_facts(items[0])
+
     def test_callable_lang(self):
         def getlang():
             return 'en'
@@ -46,6 +157,13 @@ class TestQueryContext(object):
         item = context.Item(itemX)
         assert_item_facts(item)
 
+    def test_list_lang(self):
+        context = QueryContext(testgraph, ['sv', 'en'], queries=[Item])
+        assert context.Item(itemX).title == Literal(u'Exempelsak', 'sv')
+        context = QueryContext(testgraph, lambda: ['en', 'sv'], queries=[Item],
+                execCache=LruExecCache())
+        assert_item_facts(context.Item(itemX))
+
 
 def test_context_factory():
     factory = QueryContext.context_factory(testgraph, 'en', queries=[Item])
@@ -54,3 +172,34 @@ def test_context_factory():
     assert_item_facts(item)
 
 
+
+
+def test_context_factory_overlays():
+    factory = QueryContext.context_factory(testgraph, 'en', queries=[Item],
+            indexed=True)
+    results = {}
+    def run(lang):
+        context = factory(lang)
+        results[lang] = context.Item(itemX).title
+    threads = [Thread(target=run, args=(lang,)) for lang in ('en', 'sv')]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert results == {'en': Literal(u'Example Item', 'en'),
+            'sv': Literal(u'Exempelsak', 'sv')}
+    assert factory()._execCache is not factory()._execCache
+
+def test_indexed_exec_cache():
+    context = QueryContext(testgraph, 'en', queries=[Item], indexed=True,
+            execCache=LruExecCache(indexed=True))
+    assert context.Item(itemX)._indexed
+    assert not QueryContext(testgraph, 'en', queries=[Item]).Item(itemX)._indexed
+    assert_raises(ValueError, QueryContext, testgraph, 'en', indexed=True,
+            execCache=LruExecCache())
+
+
+def test_context_factory_shared_cache():
+    cache = LruExecCache()
+    factory = QueryContext.context_factory(testgraph, 'en', queries=[Item],
+            execCache=cache)
+    assert factory().Item(itemX) is factory().Item(itemX)
+    assert cache.hits == 1
@@ -4,7 +4,7 @@ import os
 import shutil
 import tempfile
 import time
-from rdflib import RDF, URIRef, Literal, ConjunctiveGraph
+from rdflib import RDF, RDFS, URIRef, Literal, ConjunctiveGraph
 from oort.util.graphs import *
 from nose.tools import assert_equals
 #=======================================================================
@@ -75,3 +75,85 @@ class TestLoaders(LoadDirBase):
             assert_equals(self.graph.value(URIRef(s), RDF.type, any=False), URIRef(o))
 
 
+
+
+class TestGenerations(LoadDirBase):
+
+    def test_generation_bumped_on_load(self):
+        graph = ConjunctiveGraph()
+        fname = "file1.n3"
+        self.write_file(fname, "<urn:s1> a <urn:T1> .")
+        os.utime(self.fpath(fname), (1000000000.123456, 1000000000.123456))
+        load_if_modified(graph, self.fpath(fname), 'n3')
+        generations = get_generations(graph)
+        first = generations.current
+        assert first > 0
+        for i in range(2):
+            load_if_modified(graph, self.fpath(fname), 'n3')
+            assert_equals(generations.current, first)
+
+    def test_query_reselects_when_stale(self):
+        from oort.rdfview import RdfQuery, one
+        class Typed(RdfQuery):
+            rdfType = one(RDF.type)
+
+        graph = ConjunctiveGraph()
+        for fname, s in [("file1.n3", "urn:s1"), ("file2.n3", "urn:s2")]:
+            self.write_file(fname, "<%s> a <urn:T1> ." % s)
+            load_if_modified(graph, self.fpath(fname), 'n3')
+        changed = Typed(graph, None, URIRef("urn:s1"))
+        unchanged = Typed(graph, None, URIRef("urn:s2"))
+        # contexts are only stamped when a result is first selected
+        assert changed._stamp is None
+        assert_equals(changed.rdfType, URIRef("urn:T1"))
+        assert_equals(unchanged.rdfType, URIRef("urn:T1"))
+        selected = unchanged._results
+
+        time.sleep(1.0)
+        self.write_file("file1.n3", "<urn:s1> a <urn:T2> .")
+        load_if_modified(graph, self.fpath("file1.n3"), 'n3')
+        assert_equals(changed.rdfType, URIRef("urn:T2"))
+        assert_equals(unchanged.rdfType, URIRef("urn:T1"))
+        assert unchanged._results is selected
+
+    def test_query_reselects_after_first_generation(self):
+        from oort.rdfview import RdfQuery, one, LruExecCache
+        class Named(RdfQuery):
+            name = one(RDFS.label)
+
+        graph = ConjunctiveGraph()
+        ctx, s = URIRef("urn:x-ctx"), URIRef("urn:s1")
+        graph.get_context(ctx).add((s, RDFS.label, Literal("old")))
+        cache = LruExecCache()
+        assert_equals(cache(Named, graph, None, s).name, Literal("old"))
+        remove_context(graph, ctx)
+        assert_equals(len(graph), 0)
+        assert_equals(cache(Named, graph, None, s).name, None)
+
+
+class TestGraphIndexes:
+
+    def test_indexes_per_graph_instance(self):
+        from oort.rdfview import TypeIndex
+        ident = URIRef("urn:x-test:graph")
+        graph, other = ConjunctiveGraph(identifier=ident), \
+                ConjunctiveGraph(identifier=ident)
+        assert TypeIndex.for_graph(graph) is not TypeIndex.for_graph(other)
+        assert get_generations(graph, create=True) is not \
+                get_generations(other, create=True)
+        assert_equals(get_generations(ConjunctiveGraph(identifier=ident)),
+                None)
+
+    def test_indexes_do_not_keep_graph(self):
+        import gc, weakref
+        from oort.rdfview import TypeIndex
+        graph = ConjunctiveGraph()
+        graph.add((URIRef("urn:s1"), RDF.type, URIRef("urn:T1")))
+        index = TypeIndex.for_graph(graph)
+        ListIndex.for_graph(graph)
+        get_generations(graph, create=True)
+        graphRef = weakref.ref(graph)
+        del graph
+        gc.collect()
+        assert graphRef() is None
+        assert index._graph is None